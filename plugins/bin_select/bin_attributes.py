@@ -1,20 +1,30 @@
+import argparse
+import sqlite3
 import sys
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 import numpy as np
-import pandas as pd
-from sqlalchemy import create_engine, text, bindparam
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.colors as colors
 import matplotlib.ticker as ticker
+from matplotlib.collections import LineCollection, PolyCollection
 from .db_tools import DbTools
+from .trace_store import TraceStore, get_traces_signature
 from matplotlib.projections import register_projection
+from matplotlib.projections.polar import PolarAxes
 from windrose import WindroseAxes
+from windrose.windrose import ZBASE
 
 DEG2RAD = np.pi / 180.0
 PLOT_BINS_WIDTH = 1 / 5
 NSECTORS = 16
 OFFSET_MARGIN = 1.2
+BAR_WIDTH = 0.8
+BAR_MARGIN = 0.05
+SPIDER_MAX_SEGMENTS = 1000
 BASE_FONTSIZE = 10
 FIGSIZE = (8, 8)
 MIN_TEXT = 4
@@ -22,71 +32,364 @@ LEGEND_BOTTOM_SPACE = 0.20
 LEGEND_X = -0.1
 LEGEND_Y = -0.60
 LEGEND_VISIBLE_SCALE = 0.63
+BIN_CACHE_BYTES = 256 * 1024 * 1024
+PLOT_TYPES = ("offset", "spider", "rose")
+TRACE_DTYPE = np.dtype(
+    [
+        ("bin_sp", np.int32),
+        ("bin_rp", np.int32),
+        ("offset", np.float32),
+        ("azimuth", np.float32),
+        ("src_line", np.float32),
+        ("src_point", np.float32),
+        ("rcv_line", np.float32),
+        ("rcv_point", np.float32),
+        ("mid_point_x", np.float64),
+        ("mid_point_y", np.float64),
+    ]
+)
 
 register_projection(WindroseAxes)
 
 
+def offset_classes(offset: float) -> np.array:
+    return np.arange(0, offset, int(offset * PLOT_BINS_WIDTH))
+
+
+def rose_histogram(bin_df: "BinTraces", offset: float) -> tuple[list, np.array]:
+    """the windrose table of a bin, the number of traces per offset class and
+    azimuth sector, the table is cached in the attrs of the bin so it is
+    calculated once per bin
+    """
+    key = ("rose_table", float(offset))
+    if (rose := bin_df.attrs.get(key)) is not None:
+        return rose
+
+    # offset classes and sectors as in windrose.histogram, the last sector
+    # wraps around to north
+    offset_bins = offset_classes(offset).tolist() + [np.inf]
+    sector = 360.0 / NSECTORS
+    sector_bins = np.arange(-sector / 2, 360.0 + sector, sector)
+    table, *_ = np.histogram2d(
+        bin_df.offset,
+        np.mod(bin_df.azimuth, 360.0),
+        bins=[offset_bins, sector_bins],
+    )
+    table[:, 0] += table[:, -1]
+    rose = (offset_bins, table[:, :-1])
+    bin_df.attrs[key] = rose
+    return rose
+
+
+def rose_labels(offset_bins: list) -> list[str]:
+    """the legend labels of the offset classes as in WindroseAxes.legend"""
+    digits = [f"{value:.1f}" for value in offset_bins[:-1]]
+    labels = [f"[{low} : {high})" for low, high in zip(digits, digits[1:])]
+    return labels + [f">{digits[-1]}"]
+
+
+class BinTraces:
+    """traces of a bin as a structured array of TRACE_DTYPE, the columns are
+    available as attributes, attrs holds values derived from the traces
+    """
+
+    def __init__(self, traces: np.ndarray):
+        self.traces = traces
+        self.attrs = {}
+
+    def __getattr__(self, name: str) -> np.ndarray:
+        if name in TRACE_DTYPE.names:
+            return self.traces[name]
+
+        raise AttributeError(name)
+
+    def __len__(self) -> int:
+        return len(self.traces)
+
+    @property
+    def empty(self) -> bool:
+        return len(self.traces) == 0
+
+    @property
+    def nbytes(self) -> int:
+        return self.traces.nbytes
+
+
+class BinCache:
+    """LRU cache of bins keyed by bin, max offset and source indexes, the least
+    recently used bins are evicted when the memory used by the traces exceeds
+    max_bytes
+    """
+
+    def __init__(self, max_bytes: int = BIN_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.bins = OrderedDict()
+        self.nbytes = 0
+        self.database = None
+
+    @staticmethod
+    def key(bin_src: int, bin_rcv: int, offset, src_indexes) -> tuple:
+        return (bin_src, bin_rcv, float(offset), tuple(sorted(src_indexes)))
+
+    def set_database(self, db_file: Path, signature: str | None = None) -> None:
+        """invalidate the cache if the database is another or a new file or
+        its traces have changed
+        """
+        db_file = Path(db_file)
+        database = (db_file.resolve(), db_file.stat().st_ino, signature)
+        with self.lock:
+            if database != self.database:
+                self._clear()
+                self.database = database
+
+    def get(self, key: tuple) -> BinTraces | None:
+        with self.lock:
+            bin_df = self.bins.get(key)
+            if bin_df is not None:
+                self.bins.move_to_end(key)
+
+            return bin_df
+
+    def put(self, key: tuple, bin_df: BinTraces) -> None:
+        nbytes = bin_df.nbytes
+        with self.lock:
+            if key in self.bins:
+                self.nbytes -= self.bins[key].attrs["nbytes"]
+
+            bin_df.attrs["nbytes"] = nbytes
+            self.bins[key] = bin_df
+            self.bins.move_to_end(key)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self.bins) > 1:
+                _, evicted_df = self.bins.popitem(last=False)
+                self.nbytes -= evicted_df.attrs["nbytes"]
+
+    def _clear(self) -> None:
+        self.bins.clear()
+        self.nbytes = 0
+
+
 class BinAttributes:
 
     def __init__(
-        self, db_file: Path, center_bin: tuple[int, int], offset, src_indexes, **kwargs
-    ) -> pd.DataFrame:
+        self,
+        db_file: Path,
+        center_bin: tuple[int, int],
+        offset,
+        src_indexes,
+        radius: int = 1,
+        bin_cache: BinCache | None = None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
-        db_uri = "".join(["sqlite:///", str(db_file)])
-        self.engine = create_engine(db_uri)
+        self.connection = sqlite3.connect(db_file, check_same_thread=False)
         self.center_bin = center_bin
         self.offset = offset
         self.src_indexes = src_indexes
+        self.radius = radius
+        self.bin_cache = bin_cache
+        if self.bin_cache:
+            self.bin_cache.set_database(
+                db_file, get_traces_signature(self.connection.cursor())
+            )
+
         self.traces_table = "traces"
-        self.bins_df = np.empty((3, 3), dtype=object)
+        self.trace_store = TraceStore(db_file)
+        if not self.trace_store.is_current(self.connection.cursor()):
+            self.trace_store = None
+
+        self.bin_directory = DbTools.bin_directory_is_current(self.connection.cursor())
+
+        size = 2 * radius + 1
+        self.bins_df = np.empty((size, size), dtype=object)
+
+    def get_bin(self, bin_src: int, bin_rcv: int) -> BinTraces:
+        return BinTraces(self.get_bin_range(bin_src, bin_src, bin_rcv, bin_rcv))
+
+    def get_bin_range(
+        self, bin_src_min: int, bin_src_max: int, bin_rcv_min: int, bin_rcv_max: int
+    ) -> np.ndarray:
+        """the traces in the range of bins as a structured array of TRACE_DTYPE,
+        only the columns used by the plots are read. The traces are sliced from
+        the trace store if it is current, otherwise queried from the database,
+        by row ranges if the traces are clustered by bin
+        """
+        if self.trace_store:
+            columns = self.trace_store.get_bin_range(
+                bin_src_min,
+                bin_src_max,
+                bin_rcv_min,
+                bin_rcv_max,
+                self.offset,
+                self.src_indexes,
+                TRACE_DTYPE.names,
+            )
+            traces = np.empty(len(columns["offset"]), dtype=TRACE_DTYPE)
+            for name, column in columns.items():
+                traces[name] = column
+
+            return traces
+
+        if self.bin_directory:
+            return self.get_row_ranges(
+                DbTools.get_row_ranges(
+                    self.connection.cursor(),
+                    bin_src_min,
+                    bin_src_max,
+                    bin_rcv_min,
+                    bin_rcv_max,
+                )
+            )
 
-    def get_bin(self, bin_src: int, bin_rcv: int) -> pd.DataFrame:
-        query = text(
-            f"SELECT * FROM {self.traces_table} WHERE "
-            f"bin_sp = :bin_sp AND bin_rp = :bin_rp AND "
-            f"src_index in :src_indexes AND offset < :max_offset;"
+        sql_string = (
+            f"SELECT {", ".join(TRACE_DTYPE.names)} FROM {self.traces_table} WHERE "
+            f"bin_sp BETWEEN ? AND ? AND "
+            f"bin_rp BETWEEN ? AND ? AND "
+            f"src_index IN ({", ".join("?" for _ in self.src_indexes)}) AND "
+            f"offset < ?;"
+        )
+        cursor = self.connection.execute(
+            sql_string,
+            (
+                bin_src_min,
+                bin_src_max,
+                bin_rcv_min,
+                bin_rcv_max,
+                *self.src_indexes,
+                self.offset,
+            ),
         )
-        query = query.bindparams(bindparam("src_indexes", expanding=True))
-        bin_df = pd.read_sql(
-            query,
-            con=self.engine,
-            params={
-                "bin_sp": bin_src,
-                "bin_rp": bin_rcv,
-                "src_indexes": self.src_indexes,
-                "max_offset": self.offset,
-            },
+        return np.fromiter(cursor, dtype=TRACE_DTYPE)
+
+    def get_row_ranges(self, row_ranges: list[tuple[int, int]]) -> np.ndarray:
+        """the traces in the row ranges, a range of consecutive rows is read
+        from consecutive pages of the clustered traces table
+        """
+        if not row_ranges:
+            return np.empty(0, dtype=TRACE_DTYPE)
+
+        sql_string = (
+            f"SELECT {", ".join(TRACE_DTYPE.names)} FROM {self.traces_table} WHERE "
+            f"({" OR ".join("rowid BETWEEN ? AND ?" for _ in row_ranges)}) AND "
+            f"src_index IN ({", ".join("?" for _ in self.src_indexes)}) AND "
+            f"offset < ?;"
         )
-        return bin_df
+        cursor = self.connection.execute(
+            sql_string,
+            (
+                *(row for row_range in row_ranges for row in row_range),
+                *self.src_indexes,
+                self.offset,
+            ),
+        )
+        return np.fromiter(cursor, dtype=TRACE_DTYPE)
+
+    def close(self) -> None:
+        self.connection.close()
+        if self.trace_store:
+            self.trace_store.close()
 
     def get_surrounding_bins(self) -> np.array:
-        for i in [-1, 0, 1]:
-            for j in [-1, 0, 1]:
-                selector = np.array([i, j], dtype=int)
-                bin = (self.center_bin + selector).tolist()
-                self.bins_df[i, j] = self.get_bin(bin[0], bin[1])
+        """get the bins within radius of the center bin and put them in the
+        bins_df array, indexed [i, j] with i, j in [-radius, radius] relative to
+        the center bin. Bins not in the cache are fetched in a single query
+        """
+        bin_src, bin_rcv = [int(v) for v in self.center_bin]
+        r = self.radius
+        bins = [
+            (bin_src + i, bin_rcv + j)
+            for i in range(-r, r + 1)
+            for j in range(-r, r + 1)
+        ]
+        bin_dfs = {}
+        if self.bin_cache:
+            for bin in bins:
+                bin_df = self.bin_cache.get(self.cache_key(bin))
+                if bin_df is not None:
+                    bin_dfs[bin] = bin_df
+
+        if missing := [bin for bin in bins if bin not in bin_dfs]:
+            bin_dfs.update(self.fetch_bins(missing))
+
+        for bin in bins:
+            self.bins_df[bin[0] - bin_src, bin[1] - bin_rcv] = bin_dfs[bin]
 
         return self.bins_df
 
+    def prefetch_bins(self, bins: list[tuple[int, int]]) -> None:
+        """fetch the bins that are not yet cached into the cache"""
+        if not self.bin_cache:
+            return
+
+        if missing := [
+            bin for bin in bins if self.bin_cache.get(self.cache_key(bin)) is None
+        ]:
+            self.fetch_bins(missing)
+
+    def cache_key(self, bin: tuple[int, int]) -> tuple:
+        return BinCache.key(*bin, self.offset, self.src_indexes)
+
+    def fetch_bins(self, bins: list[tuple[int, int]]) -> dict:
+        """fetch the bins with a single range query over the bounding box of
+        bins and split them in memory, fetched bins are added to the cache
+        """
+        bin_srcs = [bin[0] for bin in bins]
+        bin_rcvs = [bin[1] for bin in bins]
+        traces = self.get_bin_range(
+            min(bin_srcs), max(bin_srcs), min(bin_rcvs), max(bin_rcvs)
+        )
+        # split the traces per bin with a stable sort on a linear bin index,
+        # so the traces of a bin keep the order of the table
+        nb_rcvs = max(bin_rcvs) - min(bin_rcvs) + 1
+        bin_index = (traces["bin_sp"] - min(bin_srcs)) * nb_rcvs + (
+            traces["bin_rp"] - min(bin_rcvs)
+        )
+        order = np.argsort(bin_index, kind="stable")
+        bin_index = bin_index[order]
+        traces = traces[order]
+        bin_dfs = {}
+        for bin in bins:
+            index = (bin[0] - min(bin_srcs)) * nb_rcvs + bin[1] - min(bin_rcvs)
+            start, end = np.searchsorted(bin_index, [index, index + 1])
+            bin_df = BinTraces(traces[start:end].copy())
+            bin_dfs[bin] = bin_df
+            if self.bin_cache:
+                self.bin_cache.put(self.cache_key(bin), bin_df)
+
+        return bin_dfs
+
 
 class Plot:
+    """base class for the diagrams of the bins, the figure and the artists
+    are created once and updated in place when the bins change
+    """
+
     def __init__(self, bins_df: np.array):
         self.bins_df = bins_df
+        self.radius = bins_df.shape[0] // 2
+        self.size = bins_df.shape[0]
         self.legend = None
         self.fig = None
         self.axes = None
+        self.axes_cartesian = None
+        self.artists = {}
+        self.blit = False
+        self.saving = False
+        self.background = None
 
     def setup_plot_cartesian(self, figsize: tuple[int, int]) -> None:
         self.fig, self.axes = plt.subplots(
-            3, 3, sharex=True, sharey=True, figsize=figsize
+            self.size, self.size, sharex=True, sharey=True, figsize=figsize
         )
         self.fig.canvas.mpl_connect("resize_event", self.on_resize)
+        self.fig.canvas.mpl_connect("draw_event", self.on_draw)
         self.fig.tight_layout(pad=1.2)
         self.fig.subplots_adjust(wspace=0, hspace=0)
         labelsize = BASE_FONTSIZE
         for i, ax in enumerate(self.axes.flat):
             ax.tick_params(axis="both", labelsize=labelsize)
-            if i == 6:
+            if i == self.bottom_left:
                 ax.tick_params(left=True, bottom=True)
                 ax.label_outer()
             else:
@@ -99,16 +402,15 @@ class Plot:
 
     def setup_plot_polar(self, figsize: tuple[int, int]) -> None:
         self.fig, axes_cartesian = plt.subplots(
-            3, 3, sharex=True, sharey=True, figsize=figsize
+            self.size, self.size, sharex=True, sharey=True, figsize=figsize
         )
         self.fig.canvas.mpl_connect("resize_event", self.on_resize)
+        self.fig.canvas.mpl_connect("draw_event", self.on_draw)
         axes = []
         self.fig.subplots_adjust(wspace=0.0, hspace=0.0)
         self.fig.tight_layout(pad=0)
-        legend_space = (
-            LEGEND_BOTTOM_SPACE if self.get_scale() > LEGEND_VISIBLE_SCALE else 0
-        )
-        self.fig.subplots_adjust(bottom=legend_space)
+        self.axes_cartesian = axes_cartesian
+        self.set_legend_space()
 
         for axc in axes_cartesian.flat:
             axc.tick_params(
@@ -123,11 +425,18 @@ class Plot:
             ax.tick_params(left=False, bottom=False, labelleft=False, labelbottom=False)
             axes.append(ax)
 
-        self.axes = np.array(axes).reshape(3, 3)
+        self.axes = np.array(axes).reshape(self.size, self.size)
 
         self.set_text_label_sizes()
         self.set_legend()
 
+    @property
+    def bottom_left(self) -> int:
+        return self.size * (self.size - 1)
+
+    def get_ax(self, i: int, j: int):
+        return self.axes[self.radius + i, self.radius + j]
+
     def get_scale(self) -> float:
         if self.fig is None:
             return 1.0
@@ -141,7 +450,7 @@ class Plot:
         for i, ax in enumerate(np.array(self.axes).flat):
             for t in ax.texts:
                 t.set_fontsize(size)
-            if i == 6:
+            if i == self.bottom_left:
                 ax.tick_params(axis="both", labelsize=size)
 
         if self.legend:
@@ -159,19 +468,139 @@ class Plot:
         else:
             self.legend.set_visible(False)
 
+    def set_legend_space(self) -> None:
+        """reserve space for the legend below the polar axes if it is visible"""
+        legend_space = (
+            LEGEND_BOTTOM_SPACE if self.get_scale() > LEGEND_VISIBLE_SCALE else 0
+        )
+        if self.fig.subplotpars.bottom == legend_space:
+            return
+
+        self.fig.subplots_adjust(bottom=legend_space)
+        if self.axes is None:
+            return
+
+        for axc, ax in zip(self.axes_cartesian.flat, self.axes.flat):
+            ax.set_position(axc.get_position())
+
     def on_resize(self, event=None) -> None:
+        """rescale text, legend and legend space to the new figure size, the
+        artists are kept, the background is saved again at the next draw
+        """
+        self.background = None
+        if self.axes_cartesian is not None:
+            self.set_legend_space()
+
         self.set_text_label_sizes()
         self.set_legend()
         self.fig.canvas.draw_idle()
 
     def plot_diagram(self, plot_fn) -> mpl.figure.Figure:
-        for i in [-1, 0, 1]:
-            for j in [-1, 0, 1]:
+        for i in range(-self.radius, self.radius + 1):
+            for j in range(-self.radius, self.radius + 1):
                 plot_fn(i, j)
 
+        self.set_limits()
         self.on_resize()
         return self.fig
 
+    def update_diagram(self, plot_fn, bins_df: np.array) -> None:
+        """update the artists with the data of bins_df and redraw, blit if the
+        limits of the axes did not change
+        """
+        self.bins_df = bins_df
+        for i in range(-self.radius, self.radius + 1):
+            for j in range(-self.radius, self.radius + 1):
+                plot_fn(i, j)
+
+        limits_changed = self.set_limits()
+        self.set_text_label_sizes()
+        self.set_legend()
+        self.redraw(limits_changed)
+
+    def set_limits(self) -> bool:
+        """set the axes limits to the data, returns True if they have changed"""
+        return False
+
+    def get_artists(self, i: int, j: int, create_fn) -> dict:
+        if (i, j) not in self.artists:
+            self.artists[i, j] = create_fn(self.get_ax(i, j))
+            for artist in self.iter_artists(self.artists[i, j]):
+                artist.set_animated(self.blit)
+
+        return self.artists[i, j]
+
+    @staticmethod
+    def iter_artists(artists: dict):
+        for artist in artists.values():
+            if isinstance(artist, np.ndarray):
+                yield from artist.flat
+
+            else:
+                yield artist
+
+    def dynamic_artists(self):
+        for artists in self.artists.values():
+            yield from self.iter_artists(artists)
+
+    def remove_artists(self) -> None:
+        for artist in self.dynamic_artists():
+            artist.remove()
+
+        self.artists = {}
+        self.background = None
+
+    def enable_blit(self) -> None:
+        """use blitting to redraw the artists that change with the bins, the
+        animated artists are excluded from a full draw and drawn on the saved
+        background
+        """
+        self.blit = True
+        for artist in self.dynamic_artists():
+            artist.set_animated(True)
+
+    def on_draw(self, event) -> None:
+        # savefig also draws, with the artists in the figure, which is not a
+        # background to blit on
+        if not self.blit or self.saving:
+            return
+
+        canvas = self.fig.canvas
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        for artist in self.dynamic_artists():
+            self.fig.draw_artist(artist)
+
+    def redraw(self, limits_changed: bool = True) -> None:
+        canvas = self.fig.canvas
+        if (
+            limits_changed
+            or not self.blit
+            or self.background is None
+            or not canvas.supports_blit
+        ):
+            canvas.draw_idle()
+            return
+
+        canvas.restore_region(self.background)
+        for artist in self.dynamic_artists():
+            self.fig.draw_artist(artist)
+        canvas.blit(self.fig.bbox)
+
+    def savefig(self, file_name: Path) -> None:
+        # animated artists are not drawn by savefig
+        blit = self.blit
+        for artist in self.dynamic_artists():
+            artist.set_animated(False)
+
+        self.saving = True
+        try:
+            self.fig.savefig(file_name)
+
+        finally:
+            self.saving = False
+            for artist in self.dynamic_artists():
+                artist.set_animated(blit)
+
     @staticmethod
     def plot():
         plt.show()
@@ -179,19 +608,29 @@ class Plot:
     def calc_bin_values(self, i: int, j: int) -> tuple[int, int, int, float, float]:
         bin_df = self.bins_df[i, j]
         bin_traces = len(bin_df)
-        try:
-            src_midline = int(np.mean((bin_df.src_line + bin_df.rcv_point)) * 0.5)
-            src_midpoint = int(np.mean((bin_df.src_point + bin_df.rcv_line)) * 0.5)
-            easting = bin_df.mid_point_x.mean()
-            northing = bin_df.mid_point_y.mean()
-        except ValueError:
-            src_midline = 0
-            src_midpoint = 0
-            easting = 0.0
-            northing = 0.0
+        if bin_df.empty:
+            return 0, 0, 0.0, 0.0, bin_traces
+
+        # station numbers are summed in float64, float32 is too coarse for the
+        # sum over a high fold bin
+        src_midline = int(
+            np.mean(bin_df.src_line + bin_df.rcv_point, dtype=np.float64) * 0.5
+        )
+        src_midpoint = int(
+            np.mean(bin_df.src_point + bin_df.rcv_line, dtype=np.float64) * 0.5
+        )
+        easting = bin_df.mid_point_x.mean()
+        northing = bin_df.mid_point_y.mean()
 
         return src_midline, src_midpoint, easting, northing, bin_traces
 
+    def bin_text(self, i: int, j: int) -> str:
+        if self.bins_df[i, j].empty:
+            return ""
+
+        src_midline, src_midpoint, *_ = self.calc_bin_values(i, j)
+        return f"{src_midline}\n" f"{src_midpoint}"
+
 
 class PlotOffset(Plot):
     def __init__(self, bins_df: np.array, fig_size: tuple[int, int]):
@@ -202,142 +641,379 @@ class PlotOffset(Plot):
         """destructor to remove all figures as otherwise they accumulate in memory"""
         plt.close("all")
 
+    @staticmethod
+    def create_artists(ax) -> dict:
+        bars = PolyCollection(
+            [], facecolors=mpl.rcParams["axes.prop_cycle"].by_key()["color"][0]
+        )
+        ax.add_collection(bars)
+        text = ax.text(0, 0, "", size=BASE_FONTSIZE, color="red")
+        return {"bars": bars, "text": text}
+
     def plot_offset(self, i: int, j: int) -> None:
-        bin_df = self.bins_df[i, j]
-        if bin_df.empty:
-            return
-        src_midline, src_midpoint, *_ = self.calc_bin_values(i, j)
-        bin_text = f"{src_midline}\n" f"{src_midpoint}"
-        offsets = sorted(list(bin_df.offset))
+        artists = self.get_artists(i, j, self.create_artists)
+        offsets = np.sort(self.bins_df[i, j].offset)
         traces = np.arange(1, len(offsets) + 1, 1)
-        self.axes[1 + i, 1 + j].bar(traces, offsets)
-        self.axes[1 + i, 1 + j].text(
-            0.02 * traces[-1],
-            0.88 * offsets[-1],
-            bin_text,
-            size=BASE_FONTSIZE,
-            color="red",
+        left = traces - BAR_WIDTH / 2
+        right = traces + BAR_WIDTH / 2
+        bottom = np.zeros_like(offsets)
+        artists["bars"].set_verts(
+            np.stack(
+                [
+                    np.column_stack([left, bottom]),
+                    np.column_stack([left, offsets]),
+                    np.column_stack([right, offsets]),
+                    np.column_stack([right, bottom]),
+                ],
+                axis=1,
+            )
+        )
+        artists["text"].set_text(self.bin_text(i, j))
+        if len(offsets):
+            artists["text"].set_position((0.02 * traces[-1], 0.88 * offsets[-1]))
+
+    def set_limits(self) -> bool:
+        max_traces = max(len(bin_df) for bin_df in self.bins_df.flat)
+        max_offset = max(
+            (bin_df.offset.max() for bin_df in self.bins_df.flat if not bin_df.empty),
+            default=1.0,
+        )
+        x_margin = BAR_MARGIN * (max(1, max_traces) - 1 + BAR_WIDTH)
+        xlim = (
+            1 - BAR_WIDTH / 2 - x_margin,
+            max(1, max_traces) + BAR_WIDTH / 2 + x_margin,
         )
+        ylim = (0, max_offset * (1 + BAR_MARGIN))
+        ax = self.get_ax(0, 0)
+        if ax.get_xlim() == xlim and ax.get_ylim() == ylim:
+            return False
+
+        ax.set_xlim(*xlim)
+        ax.set_ylim(*ylim)
+        return True
 
     def diagram(self):
         return self.plot_diagram(self.plot_offset)
 
+    def update(self, bins_df: np.array) -> None:
+        self.update_diagram(self.plot_offset, bins_df)
+
 
 class PlotSpider(Plot):
 
-    def __init__(self, bins_df: np.array, offset: float, figsize: tuple[int, int]):
+    def __init__(
+        self,
+        bins_df: np.array,
+        offset: float,
+        figsize: tuple[int, int],
+        max_segments: int = SPIDER_MAX_SEGMENTS,
+    ):
         super().__init__(bins_df)
         self.offset = offset
+        self.max_segments = max_segments
         self.setup_plot_cartesian(figsize)
 
     def __del__(self):
         """destructor to remove all figures as otherwise they accumulate in memory"""
         plt.close("all")
 
+    @staticmethod
+    def create_artists(ax) -> dict:
+        lines = LineCollection(
+            [],
+            linewidths=1,
+            cmap=mpl.colormaps.get_cmap("cool"),
+            norm=colors.Normalize(),
+        )
+        ax.add_collection(lines)
+        ax.set_aspect("equal")
+        text = ax.text(0, 0, "", size=BASE_FONTSIZE, color="red")
+        return {"lines": lines, "text": text}
+
+    def decimate(self, offsets: np.ndarray, azimuths: np.ndarray) -> tuple:
+        """limit the number of lines in a bin to max_segments, take every n-th
+        trace sorted by offset so the offset distribution is kept
+        """
+        if not self.max_segments or len(offsets) <= self.max_segments:
+            return offsets, azimuths
+
+        order = np.argsort(offsets, kind="stable")
+        selection = order[
+            np.linspace(0, len(offsets) - 1, self.max_segments).astype(int)
+        ]
+        return offsets[selection], azimuths[selection]
+
     def plot_spider(self, i: int, j: int) -> None:
+        artists = self.get_artists(i, j, self.create_artists)
         bin_df = self.bins_df[i, j]
-        if bin_df.empty:
-            return
-        max_offset = self.offset
-        src_midline, src_midpoint, *_ = self.calc_bin_values(i, j)
-        bin_text = f"{src_midline}\n" f"{src_midpoint}"
-        azimuths = bin_df.azimuth * DEG2RAD
-        offsets = bin_df.offset
-        eastings = 0 + offsets * np.cos(azimuths)
-        northings = 0 + offsets * np.sin(azimuths)
-        cmap = mpl.colormaps.get_cmap("cool")
-        norm = colors.Normalize(vmin=0, vmax=max_offset)
-
-        for easting, northing in zip(eastings, northings):
-            line_color = cmap(norm(np.sqrt(easting * easting + northing * northing)))
-            self.axes[1 + i, 1 + j].plot(
-                [0, northing], [0, easting], color=line_color, linewidth=1
-            )
-
-        max_offset *= OFFSET_MARGIN
-        self.axes[1 + i, 1 + j].set_xlim(-max_offset, max_offset)
-        self.axes[1 + i, 1 + j].set_ylim(-max_offset, max_offset)
-        self.axes[1 + i, 1 + j].set_aspect("equal")
-        self.axes[1 + i, 1 + j].text(
-            -max_offset * 0.95,
-            -max_offset * 0.95,
-            bin_text,
-            size=BASE_FONTSIZE,
-            color="red",
+        offsets, azimuths = self.decimate(
+            bin_df.offset.astype(np.float64),
+            bin_df.azimuth.astype(np.float64) * DEG2RAD,
         )
+        segments = np.zeros((len(offsets), 2, 2))
+        segments[:, 1, 0] = offsets * np.sin(azimuths)
+        segments[:, 1, 1] = offsets * np.cos(azimuths)
+        artists["lines"].set_segments(segments)
+        artists["lines"].set_array(offsets)
+        artists["lines"].set_clim(0, self.offset)
+        max_offset = self.offset * OFFSET_MARGIN
+        artists["text"].set_text(self.bin_text(i, j))
+        artists["text"].set_position((-max_offset * 0.95, -max_offset * 0.95))
+
+    def set_limits(self) -> bool:
+        max_offset = self.offset * OFFSET_MARGIN
+        lim = (-max_offset, max_offset)
+        ax = self.get_ax(0, 0)
+        if ax.get_xlim() == lim and ax.get_ylim() == lim:
+            return False
+
+        ax.set_xlim(*lim)
+        ax.set_ylim(*lim)
+        return True
 
     def diagram(self):
         return self.plot_diagram(self.plot_spider)
 
+    def update(self, bins_df: np.array, offset: float) -> None:
+        self.offset = offset
+        self.update_diagram(self.plot_spider, bins_df)
+
 
 class PlotRose(Plot):
     def __init__(self, bins_df: np.array, offset: float, figsize: tuple[int, int]):
         super().__init__(bins_df)
         self.offset = offset
+        self.tables = {}
         self.setup_plot_polar(figsize)
 
     def __del__(self):
         """destructor to remove all figures as otherwise they accumulate in memory"""
         plt.close("all")
 
-    def plot_rose(self, i: int, j: int) -> None:
-        bin_df = self.bins_df[i, j]
-        if bin_df.empty:
-            return
-        src_midline, src_midpoint, *_ = self.calc_bin_values(i, j)
-        bin_text = f"{src_midline}\n" f"{src_midpoint}"
-        azimuths = np.array(
-            [(azimuth + 360 if azimuth < 0 else azimuth) for azimuth in bin_df.azimuth]
-        )
-        offsets = bin_df.offset
-
-        self.axes[1 + i, 1 + j].text(
+    @property
+    def offset_bins(self) -> np.array:
+        return offset_classes(self.offset)
+
+    def create_artists(self, ax) -> dict:
+        # the bars of the windrose, one rectangle per offset bin and sector,
+        # as drawn by WindroseAxes.bar. WindroseAxes overrides bar and legend
+        # to calculate the histogram itself, so the bars and the legend of the
+        # cached rose table are drawn with the methods of PolarAxes
+        nbins = len(self.offset_bins)
+        bar_colors = plt.get_cmap()(np.linspace(0.0, 1.0, nbins))
+        dtheta = 2 * np.pi / NSECTORS
+        angles = np.arange(0, -2 * np.pi, -dtheta) + np.pi / 2
+        bars = np.empty((nbins, NSECTORS), dtype=object)
+        for i in range(nbins):
+            bars[i] = PolarAxes.bar(
+                ax,
+                angles,
+                np.zeros(NSECTORS),
+                width=dtheta,
+                color=bar_colors[i],
+                edgecolor="white",
+                zorder=ZBASE + nbins - i,
+            ).patches
+
+        # bar autoscales the radius, the rose starts at the origin
+        ax.set_rmin(0)
+        text = ax.text(
             0.02,
             0.02,
-            bin_text,
+            "",
             size=BASE_FONTSIZE,
             color="red",
-            transform=self.axes[1 + i][1 + j].transAxes,
+            transform=ax.transAxes,
             ha="left",
             va="bottom",
         )
-        self.axes[1 + i][1 + j].bar(
-            azimuths,
-            offsets,
-            bins=np.arange(0, self.offset, int(self.offset * PLOT_BINS_WIDTH)),
-            opening=1.0,
-            nsector=NSECTORS,
-            edgecolor="white",
-        )
-        if i == 1 and j == -1:
-            self.legend = self.axes[1 +i][1 +j].legend(
+        return {"bars": bars, "text": text}
+
+    def plot_rose(self, i: int, j: int) -> None:
+        ax = self.get_ax(i, j)
+        artists = self.get_artists(i, j, self.create_artists)
+        offset_bins, table = rose_histogram(self.bins_df[i, j], self.offset)
+        self.tables[i, j] = table
+        bottoms = np.cumsum(table, axis=0) - table
+        for bar, bottom, height in zip(artists["bars"].flat, bottoms.flat, table.flat):
+            bar.set_y(bottom)
+            bar.set_height(height)
+
+        artists["text"].set_text(self.bin_text(i, j))
+        if i == self.radius and j == -self.radius and not self.legend:
+            handles = [
+                mpl.patches.Rectangle(
+                    (0, 0), 0.2, 0.2, facecolor=bar.get_facecolor(), edgecolor="black"
+                )
+                for bar in artists["bars"][:, 0]
+            ]
+            self.legend = PolarAxes.legend(
+                ax,
+                handles,
+                rose_labels(offset_bins),
+                loc="lower left",
                 bbox_to_anchor=(LEGEND_X, LEGEND_Y),
             )
 
+    def set_limits(self) -> bool:
+        limits_changed = False
+        for (i, j), table in self.tables.items():
+            ax = self.get_ax(i, j)
+            rmax = max(1.0, np.sum(table, axis=0).max())
+            if ax.get_rmax() != rmax:
+                ax.set_rmax(rmax)
+                ax.set_radii_angle(angle=ax.radii_angle)
+                limits_changed = True
+
+        return limits_changed
+
     def diagram(self) -> mpl.figure.Figure:
         return self.plot_diagram(self.plot_rose)
 
+    def update(self, bins_df: np.array, offset: float) -> None:
+        if offset != self.offset:
+            # the offset bins change with offset, so bars and legend are recreated
+            self.offset = offset
+            self.remove_artists()
+            if self.legend:
+                self.legend.remove()
+                self.legend = None
+
+        self.update_diagram(self.plot_rose, bins_df)
+
+
+def draw_plot(
+    plots: dict, plot_type: str, bins_df: np.array, offset: float, figsize
+) -> Plot:
+    """create the plot of plot_type on first use and update its artists for
+    next bins
+    """
+    if plot_type not in plots:
+        if plot_type == "offset":
+            plots[plot_type] = PlotOffset(bins_df, figsize)
+
+        elif plot_type == "spider":
+            plots[plot_type] = PlotSpider(bins_df, offset, figsize)
+
+        else:
+            plots[plot_type] = PlotRose(bins_df, offset, figsize)
+
+        plots[plot_type].diagram()
+
+    elif plot_type == "offset":
+        plots[plot_type].update(bins_df)
+
+    else:
+        plots[plot_type].update(bins_df, offset)
+
+    return plots[plot_type]
+
+
+def parse_bin(value: str) -> tuple[int, int]:
+    bin_src, bin_rcv = [int(v) for v in value.replace(",", " ").split()]
+    return bin_src, bin_rcv
+
+
+def parse_args(argv: list) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="bin_attributes",
+        description="plot offset, spider and rose diagrams of bins",
+    )
+    parser.add_argument("db_file", type=Path, help="bins database file")
+    bins = parser.add_mutually_exclusive_group(required=True)
+    bins.add_argument(
+        "--bin",
+        dest="bins",
+        type=parse_bin,
+        action="append",
+        help="center bin 'src, rcv', can be repeated",
+    )
+    bins.add_argument(
+        "--range",
+        type=int,
+        nargs=4,
+        metavar=("SRC_MIN", "SRC_MAX", "RCV_MIN", "RCV_MAX"),
+        help="all center bins in the range",
+    )
+    parser.add_argument("--step", type=int, default=1, help="step in the range")
+    parser.add_argument("--radius", type=int, default=1, help="bins around center")
+    parser.add_argument("--offset", type=float, help="max offset (seis_config)")
+    parser.add_argument(
+        "--src-indexes",
+        type=lambda value: [int(i) for i in value.split(",")],
+        help="source indexes, comma separated (seis_config)",
+    )
+    parser.add_argument(
+        "--plots",
+        nargs="+",
+        choices=PLOT_TYPES,
+        default=list(PLOT_TYPES),
+        help="plots to make",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["png", "pdf", "svg", "show", "none"],
+        default="png",
+        help="save plots as file, show them or only render them (none)",
+    )
+    parser.add_argument("--out", type=Path, default=Path("."), help="output folder")
+    parser.add_argument(
+        "--figsize", type=float, nargs=2, default=FIGSIZE, help="width height"
+    )
+    args = parser.parse_args(argv[1:])
+    if args.range:
+        src_min, src_max, rcv_min, rcv_max = args.range
+        args.bins = [
+            (bin_src, bin_rcv)
+            for bin_src in range(src_min, src_max + 1, args.step)
+            for bin_rcv in range(rcv_min, rcv_max + 1, args.step)
+        ]
+
+    return args
+
 
 def main(argv: list):
-    if len(argv) != 2:
-        print("Provide the bins database file as argument!")
-        sys.exit()
-
-    db_file = Path(argv[1])
-    center_bin = np.array([502, 675], dtype=int)
-    config = DbTools(db_file).get_config_from_db()
-    ba = BinAttributes(db_file, center_bin, config["offset"], config["src_indexes"])
-    bins_df = ba.get_surrounding_bins()
-    figsize = (6, 6)
-    plot_offset = PlotOffset(bins_df, figsize)
-    plot_offset.diagram()
-    plot_offset.plot()
-    plot_spider = PlotSpider(bins_df, config["offset"], figsize)
-    plot_spider.diagram()
-    plot_spider.plot()
-    plot_rose = PlotRose(bins_df, config["offset"], figsize)
-    plot_rose.diagram()
-    plot_rose.plot()
+    """plots the bins given on the command line, the time of the query and of
+    each plot is printed per bin. Without --format show no display is needed
+    """
+    args = parse_args(argv)
+    if args.format != "show":
+        mpl.use("Agg")
+
+    config = DbTools(args.db_file).config
+    offset = config.offset if args.offset is None else args.offset
+    src_indexes = config.src_indexes if args.src_indexes is None else args.src_indexes
+    ba = BinAttributes(args.db_file, args.bins[0], offset, src_indexes, args.radius)
+    if args.format in ("png", "pdf", "svg"):
+        args.out.mkdir(parents=True, exist_ok=True)
+
+    plots = {}
+    for center_bin in args.bins:
+        ba.center_bin = center_bin
+        start = time.perf_counter()
+        bins_df = ba.get_surrounding_bins()
+        timings = [f"query {time.perf_counter() - start:.3f} s"]
+        for plot_type in args.plots:
+            start = time.perf_counter()
+            plot = draw_plot(plots, plot_type, bins_df, offset, args.figsize)
+            if args.format == "show":
+                plot.plot()
+                del plots[plot_type]
+
+            elif args.format == "none":
+                plot.fig.canvas.draw()
+
+            else:
+                plot.savefig(
+                    args.out
+                    / f"bin_{plot_type}_{center_bin[0]}_{center_bin[1]}.{args.format}"
+                )
+
+            timings.append(f"{plot_type} {time.perf_counter() - start:.3f} s")
+
+        print(f"bin {center_bin[0]}, {center_bin[1]}: {", ".join(timings)}")
+
+    ba.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,304 @@
+"""benchmarks of the query, binning, plot and export paths of bin_select on a
+survey database, the results are written as JSON and can be compared with the
+results of a previous run to catch regressions
+"""
+
+import argparse
+import json
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+import matplotlib
+from .db_tools import DbTools
+from .bin_attributes import PLOT_TYPES, BinAttributes, BinCache, draw_plot
+from .bin_export import BinExport
+from .survey_generator import Geometry, SurveyGenerator
+
+SCENARIOS = (
+    "get_bin",
+    "click_to_plot",
+    "bin_traces",
+    "bin_traces_incremental",
+    "bin_traces_fold_cube",
+    "bin_traces_numpy",
+    "bin_traces_parallel",
+    "bulk_export",
+)
+RUNS = 5
+CLICKS = 20
+EXPORT_EVERY_NTH = 50
+REGRESSION_FACTOR = 1.2
+FIGSIZE = (8, 8)
+
+
+class Benchmark:
+    """times the scenarios on a copy of the database, so the bins and
+    seis_config of the database are not changed
+    """
+
+    def __init__(
+        self,
+        db_file: Path,
+        work_folder: Path,
+        runs: int = RUNS,
+        trace_store: bool = False,
+        cluster: bool = False,
+    ):
+        self.work_folder = Path(work_folder)
+        self.db_file = self.work_folder / f"benchmark_{Path(db_file).name}"
+        shutil.copy(db_file, self.db_file)
+        self.runs = runs
+        self.db_tools = DbTools(self.db_file)
+        if cluster:
+            self.db_tools.cluster_traces(None)
+
+        if trace_store:
+            self.db_tools.build_trace_store(None)
+
+        self.config = self.db_tools.config
+        self.rng = np.random.default_rng(0)
+
+    def random_bins(self, number: int) -> list[tuple[int, int]]:
+        bin_sp = self.rng.integers(2, max(3, self.config.nb_bin_sp), number)
+        bin_rp = self.rng.integers(2, max(3, self.config.nb_bin_rp), number)
+        return [(int(sp), int(rp)) for sp, rp in zip(bin_sp, bin_rp)]
+
+    def time_runs(self, run_fn, setup_fn=None) -> dict:
+        times = []
+        for _ in range(self.runs):
+            if setup_fn:
+                setup_fn()
+
+            start = time.perf_counter()
+            run_fn()
+            times.append(time.perf_counter() - start)
+
+        return {
+            "runs": times,
+            "min": min(times),
+            "median": float(np.median(times)),
+            "mean": float(np.mean(times)),
+        }
+
+    def get_bin(self) -> dict:
+        """query of a single bin, time per bin"""
+        ba = BinAttributes(
+            self.db_file, (1, 1), self.config.offset, self.config.src_indexes
+        )
+        bins = self.random_bins(CLICKS)
+
+        def run():
+            for bin in bins:
+                ba.get_bin(*bin)
+
+        result = self.per_unit(self.time_runs(run), CLICKS)
+        ba.close()
+        return result
+
+    def click_to_plot(self) -> dict:
+        """query of the 3x3 bins around a clicked bin with an empty cache and
+        the update and draw of the three plots, time per click
+        """
+        plots = {}
+        bins = self.random_bins(CLICKS)
+
+        def run():
+            for bin in bins:
+                ba = BinAttributes(
+                    self.db_file,
+                    bin,
+                    self.config.offset,
+                    self.config.src_indexes,
+                    bin_cache=BinCache(),
+                )
+                bins_df = ba.get_surrounding_bins()
+                ba.close()
+                for plot_type in PLOT_TYPES:
+                    plot = draw_plot(
+                        plots, plot_type, bins_df, self.config.offset, FIGSIZE
+                    )
+                    plot.fig.canvas.draw()
+
+        # the first run creates the figures
+        run()
+        return self.per_unit(self.time_runs(run), CLICKS)
+
+    def bin_traces(self) -> dict:
+        return self.time_runs(
+            lambda: self.db_tools.bin_traces(
+                self.config.offset, self.config.src_indexes
+            )
+        )
+
+    def bin_traces_incremental(self) -> dict:
+        """rebinning to another offset and back"""
+        offsets = [self.config.offset, self.config.offset * 0.75]
+        self.db_tools.bin_traces(self.config.offset, self.config.src_indexes)
+
+        def run():
+            offsets.reverse()
+            self.db_tools.bin_traces_incremental(offsets[0], self.config.src_indexes)
+
+        return self.time_runs(run)
+
+    def bin_traces_fold_cube(self) -> dict:
+        """binning from the fold cube, the time to build the cube is reported
+        separately
+        """
+        start = time.perf_counter()
+        self.db_tools.build_fold_cube()
+        build_time = time.perf_counter() - start
+        result = self.time_runs(
+            lambda: self.db_tools.bin_traces_fold_cube(
+                self.config.offset, self.config.src_indexes
+            )
+        )
+        result["build"] = build_time
+        return result
+
+    def bin_traces_numpy(self) -> dict:
+        return self.time_runs(
+            lambda: self.db_tools.bin_traces_numpy(
+                self.config.offset, self.config.src_indexes
+            )
+        )
+
+    def bin_traces_parallel(self) -> dict:
+        return self.time_runs(
+            lambda: self.db_tools.bin_traces_parallel(
+                self.config.offset, self.config.src_indexes
+            )
+        )
+
+    def bulk_export(self) -> dict:
+        """export of every nth bin, time per bin"""
+        export_folder = self.work_folder / "export"
+        bin_export = BinExport(self.db_file, export_folder, every_nth=EXPORT_EVERY_NTH)
+        nb_bins = len(bin_export.get_bins())
+        result = self.time_runs(
+            bin_export.export,
+            setup_fn=lambda: shutil.rmtree(export_folder, ignore_errors=True),
+        )
+        return self.per_unit(result, max(1, nb_bins))
+
+    @staticmethod
+    def per_unit(result: dict, units: int) -> dict:
+        result = {
+            key: ([t / units for t in value] if key == "runs" else value / units)
+            for key, value in result.items()
+        }
+        result["units"] = units
+        return result
+
+    def run(self, scenarios: tuple[str], progress=None) -> dict:
+        results = {}
+        for scenario in scenarios:
+            if progress:
+                progress(scenario)
+
+            results[scenario] = getattr(self, scenario)()
+
+        self.db_tools.close()
+        return results
+
+
+def compare(results: dict, baseline: dict, factor: float) -> list[str]:
+    """returns the scenarios with a median time of more than factor times the
+    median time in the baseline
+    """
+    regressions = []
+    for scenario, result in results["results"].items():
+        if not (base := baseline.get("results", {}).get(scenario)):
+            continue
+
+        if result["median"] > factor * base["median"]:
+            regressions.append(
+                f"{scenario}: {result["median"]:.4f} s against "
+                f"{base["median"]:.4f} s"
+            )
+
+    return regressions
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="bin_benchmark", description="benchmark bin_select"
+    )
+    parser.add_argument("db_file", type=Path, nargs="?", help="survey database")
+    parser.add_argument(
+        "--generate",
+        type=int,
+        metavar="TRACES",
+        help="benchmark a generated survey with this number of traces",
+    )
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--runs", type=int, default=RUNS)
+    parser.add_argument(
+        "--trace-store",
+        action="store_true",
+        help="read the traces from a trace store built on the copy",
+    )
+    parser.add_argument(
+        "--cluster", action="store_true", help="cluster the traces of the copy by bin"
+    )
+    parser.add_argument("--json", type=Path, help="write the results to this file")
+    parser.add_argument("--compare", type=Path, help="results of a previous run")
+    parser.add_argument("--factor", type=float, default=REGRESSION_FACTOR)
+    args = parser.parse_args(argv[1:])
+    matplotlib.use("Agg")
+    if not args.db_file and not args.generate:
+        parser.error("give a database or --generate")
+
+    with tempfile.TemporaryDirectory() as work_folder:
+        work_folder = Path(work_folder)
+        db_file = args.db_file
+        if args.generate:
+            db_file = work_folder / "synthetic.sqlite"
+            start = time.perf_counter()
+            SurveyGenerator(db_file, Geometry.from_traces(args.generate)).generate()
+            print(
+                f"generated {args.generate} traces in "
+                f"{time.perf_counter() - start:.1f} s",
+                file=sys.stderr,
+            )
+
+        benchmark = Benchmark(
+            db_file,
+            work_folder,
+            runs=args.runs,
+            trace_store=args.trace_store,
+            cluster=args.cluster,
+        )
+        results = {
+            "database": str(args.db_file or f"generated {args.generate} traces"),
+            "traces": benchmark.db_tools.get_traces_count(),
+            "trace_store": args.trace_store,
+            "cluster": args.cluster,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": benchmark.run(
+                args.scenarios,
+                progress=lambda scenario: print(scenario, file=sys.stderr),
+            ),
+        }
+
+    output = json.dumps(results, indent=2)
+    if args.json:
+        args.json.write_text(output)
+
+    else:
+        print(output)
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        if regressions := compare(results, baseline, args.factor):
+            print("regressions:\n" + "\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,279 @@
+"""export of the offset, spider and rose plots of many bins, the bins are
+rendered in batches with the Agg backend in a pool of processes
+"""
+
+import argparse
+import json
+import sys
+from concurrent.futures import as_completed
+from pathlib import Path
+import matplotlib
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from matplotlib.image import imread
+from .db_tools import DbTools
+from .mp_tools import get_workers, process_pool
+from .bin_attributes import PLOT_TYPES, BinAttributes, BinCache, draw_plot
+
+EXPORT_PLOTS = PLOT_TYPES
+EXPORT_FIGSIZE = (8, 8)
+EXPORT_BATCH_SIZE = 25
+EXPORT_BIN_RADIUS = 1
+PDF_FILE_NAME = "bin_plots.pdf"
+MANIFEST_FILE_NAME = "export.json"
+
+
+def export_file_name(out_folder: Path, bin: tuple[int, int], plot: str) -> Path:
+    return Path(out_folder) / f"bin_{plot}_{bin[0]}_{bin[1]}.png"
+
+
+def init_worker():
+    matplotlib.use("Agg")
+
+
+def export_batch(
+    db_file: Path,
+    bins: list[tuple[int, int]],
+    offset: float,
+    src_indexes: list[int],
+    plots: tuple[str],
+    out_folder: Path,
+    figsize: tuple[int, int] = EXPORT_FIGSIZE,
+) -> int:
+    """render the plots of a batch of bins to PNG files, the traces of all
+    bins of the batch are fetched in one query and the figures are created
+    once and updated for each bin. Files are written under a temporary name
+    and renamed, so an interrupted export leaves no partial files
+    """
+    bin_cache = BinCache()
+    ba = BinAttributes(
+        db_file,
+        bins[0],
+        offset,
+        src_indexes,
+        radius=EXPORT_BIN_RADIUS,
+        bin_cache=bin_cache,
+    )
+    r = EXPORT_BIN_RADIUS
+    ba.prefetch_bins(
+        list(
+            {
+                (bin[0] + i, bin[1] + j)
+                for bin in bins
+                for i in range(-r, r + 1)
+                for j in range(-r, r + 1)
+            }
+        )
+    )
+    figures = {}
+    try:
+        for bin in bins:
+            ba.center_bin = bin
+            bins_df = ba.get_surrounding_bins()
+            for plot in plots:
+                draw_plot(figures, plot, bins_df, offset, figsize)
+                file_name = export_file_name(out_folder, bin, plot)
+                tmp_file_name = file_name.with_suffix(".part.png")
+                figures[plot].savefig(tmp_file_name)
+                tmp_file_name.replace(file_name)
+
+    finally:
+        ba.close()
+
+    return len(bins)
+
+
+class BinExport:
+    """export the plots of every nth bin, or of the bins with a fold up to
+    max_fold, to PNG files in out_folder and optionally a multi-page PDF.
+    Bins of which all plots exist are skipped, so a stopped export resumes
+    where it was left. The offset, source indexes and traces of the plots are
+    kept in a manifest, plots exported with other parameters are removed.
+    Bins without traces are only exported with include_empty
+    """
+
+    def __init__(
+        self,
+        db_file: Path,
+        out_folder: Path,
+        every_nth: int = 1,
+        max_fold: int | None = None,
+        include_empty: bool = False,
+        offset: float | None = None,
+        src_indexes: list[int] | None = None,
+        plots: tuple[str] = EXPORT_PLOTS,
+        pdf: bool = False,
+        workers: int | None = None,
+    ):
+        self.db_file = Path(db_file)
+        self.out_folder = Path(out_folder)
+        self.every_nth = max(1, every_nth)
+        self.max_fold = max_fold
+        self.include_empty = include_empty
+        db_tools = DbTools(self.db_file)
+        config = db_tools.config
+        self.traces_signature = db_tools.get_traces_signature()
+        db_tools.release_connection()
+        self.offset = config.offset if offset is None else offset
+        self.src_indexes = config.src_indexes if src_indexes is None else src_indexes
+        self.plots = plots
+        self.pdf = pdf
+        self.workers = get_workers(workers)
+
+    def get_bins(self) -> list[tuple[int, int]]:
+        db_tools = DbTools(self.db_file)
+        bins = (
+            db_tools.get_bins(
+                self.every_nth, self.max_fold, include_empty=self.include_empty
+            )
+            or []
+        )
+        db_tools.release_connection()
+        return [tuple(bin) for bin in bins]
+
+    def get_manifest(self) -> dict:
+        return {
+            "offset": self.offset,
+            "src_indexes": sorted(self.src_indexes),
+            "traces": self.traces_signature,
+        }
+
+    def remove_stale_plots(self):
+        """removes the plots and PDF in out_folder if the manifest is missing
+        or differs from the export parameters and writes the manifest
+        """
+        manifest_file = self.out_folder / MANIFEST_FILE_NAME
+        manifest = self.get_manifest()
+        try:
+            if json.loads(manifest_file.read_text()) == manifest:
+                return
+
+        except (OSError, ValueError):
+            pass
+
+        for file_name in self.out_folder.glob("bin_*.png"):
+            file_name.unlink()
+
+        (self.out_folder / PDF_FILE_NAME).unlink(missing_ok=True)
+        manifest_file.write_text(json.dumps(manifest, indent=2))
+
+    def is_exported(self, bin: tuple[int, int]) -> bool:
+        return all(
+            export_file_name(self.out_folder, bin, plot).exists() for plot in self.plots
+        )
+
+    def export(self, progress=None, cancelled=None) -> int:
+        """export the bins, progress is called with the number of bins done and
+        the total number of bins, the export stops when cancelled returns True.
+        Returns the number of bins exported
+        """
+        self.out_folder.mkdir(parents=True, exist_ok=True)
+        self.remove_stale_plots()
+        bins = self.get_bins()
+        pending = [bin for bin in bins if not self.is_exported(bin)]
+        done = len(bins) - len(pending)
+        if progress:
+            progress(done, len(bins))
+
+        batches = [
+            pending[i : i + EXPORT_BATCH_SIZE]
+            for i in range(0, len(pending), EXPORT_BATCH_SIZE)
+        ]
+        exported = 0
+        if batches:
+            with process_pool(
+                min(self.workers, len(batches)), initializer=init_worker
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        export_batch,
+                        self.db_file,
+                        batch,
+                        self.offset,
+                        self.src_indexes,
+                        self.plots,
+                        self.out_folder,
+                    )
+                    for batch in batches
+                ]
+                for future in as_completed(futures):
+                    exported += future.result()
+                    if progress:
+                        progress(done + exported, len(bins))
+
+                    if cancelled and cancelled():
+                        executor.shutdown(wait=True, cancel_futures=True)
+                        return exported
+
+        if self.pdf:
+            self.write_pdf(bins)
+
+        return exported
+
+    def write_pdf(self, bins: list[tuple[int, int]]) -> Path:
+        """combine the exported PNG files in a PDF with a page per plot"""
+        pdf_file = self.out_folder / PDF_FILE_NAME
+        with PdfPages(pdf_file) as pdf:
+            for bin in bins:
+                for plot in self.plots:
+                    image = imread(export_file_name(self.out_folder, bin, plot))
+                    height, width, _ = image.shape
+                    fig = Figure(figsize=(width / 100, height / 100), dpi=100)
+                    ax = fig.add_axes((0, 0, 1, 1))
+                    ax.imshow(image)
+                    ax.set_axis_off()
+                    pdf.savefig(fig)
+
+        return pdf_file
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="bin_export",
+        description="export offset, spider and rose plots of bins",
+    )
+    parser.add_argument("db_file", type=Path, help="bins database file")
+    parser.add_argument("out_folder", type=Path, help="folder for the plots")
+    parser.add_argument("--every", type=int, default=1, help="every nth bin")
+    parser.add_argument("--max-fold", type=int, help="only bins up to this fold")
+    parser.add_argument(
+        "--include-empty", action="store_true", help="also bins without traces"
+    )
+    parser.add_argument("--offset", type=float, help="max offset (seis_config)")
+    parser.add_argument(
+        "--src-indexes",
+        type=lambda value: [int(i) for i in value.split(",")],
+        help="source indexes, comma separated (seis_config)",
+    )
+    parser.add_argument(
+        "--plots",
+        nargs="+",
+        choices=EXPORT_PLOTS,
+        default=list(EXPORT_PLOTS),
+        help="plots to export",
+    )
+    parser.add_argument("--pdf", action="store_true", help="also write a PDF")
+    parser.add_argument("--workers", type=int, help="number of processes")
+    args = parser.parse_args(argv[1:])
+
+    def print_progress(done, total):
+        print(f"\rexported {done} of {total} bins", end="", flush=True)
+
+    bin_export = BinExport(
+        args.db_file,
+        args.out_folder,
+        every_nth=args.every,
+        max_fold=args.max_fold,
+        include_empty=args.include_empty,
+        offset=args.offset,
+        src_indexes=args.src_indexes,
+        plots=tuple(args.plots),
+        pdf=args.pdf,
+        workers=args.workers,
+    )
+    bin_export.export(progress=print_progress)
+    print()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -44,6 +44,10 @@ class SelectBin:
             return None, None
 
         if bin_id:
+            if self.bin_attr_window and self.bin_attr_window.isVisible():
+                self.bin_attr_window.set_bin(bin_id)
+                return bin_id, None
+
             dbname = QgsDataSourceUri(self.layer.source()).database()
             self.bin_attr_window = BinAttributesView(dbname, bin_id)
             return bin_id, self.bin_attr_window.selected_bin_changed
@@ -75,7 +79,8 @@ class SelectMapTool(QgsMapToolEmitPoint):
         )
         if bin_id:
             self.show_marker()
-            bin_changed_handler.connect(self.bin_changed_action)
+            if bin_changed_handler:
+                bin_changed_handler.connect(self.bin_changed_action)
 
     def bin_changed_action(self, changed_bin_val):
         if changed_bin_val == "quit":
@@ -5,8 +5,13 @@ email: bvermeulen@hotmail.com
 admin@howdiweb.nl
 """
 
-MOUSE_RELEASE_TRIGGER = 350
+CONFIG_WRITE_DELAY = 1000
+EXPORT_EVERY_NTH = 10
+EXPORT_FOLDER = "bin_export"
 FIGSIZE_PYQT_PLOT = (6.3125, 5.833)
+BIN_RADIUS = 1
+PREFETCH_MAX_STEP = 2 * BIN_RADIUS + 1
+SETTINGS_NOT_SAVED = "Settings not saved, the database is busy, try again"
 
 import time
 import datetime
@@ -14,12 +19,21 @@ import numpy as np
 from functools import partial
 import warnings
 from pathlib import Path
-from qgis.PyQt.QtCore import QThread, pyqtSignal, QTimer
+from qgis.PyQt.QtCore import QObject, QThread, pyqtSignal, QTimer
 from qgis.PyQt import uic, QtWidgets
 import matplotlib
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
-from .db_tools import DbTools
-from .bin_attributes import BinAttributes, PlotOffset, PlotSpider, PlotRose
+from .db_tools import BINNING_ENGINES, BinningCancelled, DbTools
+from .bin_export import BinExport
+from .bin_attributes import (
+    BinAttributes,
+    BinCache,
+    Plot,
+    PlotOffset,
+    PlotSpider,
+    PlotRose,
+    rose_histogram,
+)
 
 matplotlib.use("QtAgg")
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -49,23 +63,439 @@ button_style_active = """
 
 
 class BinningThread(QThread):
-    binning_finished = pyqtSignal()
+    """bins the traces with the engine, binning_finished is emitted with an
+    empty message when done, otherwise with the reason it was not
+    """
 
-    def __init__(self, db_tools: DbTools, offset: float, src_indexes: list[int, int]):
+    binning_progress = pyqtSignal(int, float)
+    binning_finished = pyqtSignal(str)
+
+    def __init__(
+        self,
+        db_tools: DbTools,
+        offset: float,
+        src_indexes: list[int, int],
+        engine: str = "fold_cube",
+    ):
+        super().__init__()
+        self.db_tools = db_tools
+        self.offset = offset
+        self.src_indexes = src_indexes
+        self.engine = engine
+        self.start_time = None
+        self.percentage = None
+
+    def run(self):
+        bin_traces = getattr(self.db_tools, BINNING_ENGINES[self.engine])
+        self.start_time = time.perf_counter()
+        message = "Binning failed, see the log"
+        try:
+            if bin_traces(
+                self.offset,
+                self.src_indexes,
+                progress=self.emit_progress,
+                cancelled=self.isInterruptionRequested,
+            ):
+                message = ""
+
+        except BinningCancelled:
+            message = "Binning cancelled"
+
+        except Exception as error:
+            print(f"error: binning {self.engine}: {error!r}")
+            message = f"Binning failed: {error}"
+
+        finally:
+            self.db_tools.release_connection()
+            self.binning_finished.emit(message)
+
+    def emit_progress(self, fraction: float):
+        """emits the percentage done and the estimated time remaining in
+        seconds at the throughput so far, -1 if not yet known. Only emitted
+        when the percentage changes
+        """
+        percentage = int(fraction * 100)
+        if percentage == self.percentage:
+            return
+
+        self.percentage = percentage
+        elapsed = time.perf_counter() - self.start_time
+        eta = elapsed * (1 - fraction) / fraction if fraction > 0 else -1.0
+        self.binning_progress.emit(percentage, eta)
+
+
+class IndexThread(QThread):
+    index_progress = pyqtSignal(int)
+    index_finished = pyqtSignal()
+
+    def __init__(self, db_tools: DbTools):
+        super().__init__()
+        self.db_tools = db_tools
+
+    def run(self):
+        try:
+            self.db_tools.create_traces_indexes(
+                self.emit_progress, cancelled=self.isInterruptionRequested
+            )
+
+        except BinningCancelled:
+            print("indexing cancelled")
+
+        finally:
+            self.db_tools.release_connection()
+            self.index_finished.emit()
+
+    def emit_progress(self, fraction: float):
+        self.index_progress.emit(int(fraction * 100))
+
+
+class ClusterThread(QThread):
+    """clusters the traces by bin, cluster_finished is emitted with an empty
+    message when done, otherwise with the reason it was not
+    """
+
+    cluster_progress = pyqtSignal(int)
+    cluster_finished = pyqtSignal(str)
+
+    def __init__(self, db_tools: DbTools):
+        super().__init__()
+        self.db_tools = db_tools
+
+    def run(self):
+        message = "Clustering traces failed, see the log"
+        try:
+            if self.db_tools.cluster_traces(
+                self.emit_progress, cancelled=self.isInterruptionRequested
+            ):
+                message = ""
+
+        except BinningCancelled:
+            message = "Clustering traces cancelled"
+
+        except Exception as error:
+            print(f"error: clustering traces: {error!r}")
+            message = f"Clustering traces failed: {error}"
+
+        finally:
+            self.db_tools.release_connection()
+            self.cluster_finished.emit(message)
+
+    def emit_progress(self, fraction: float):
+        self.cluster_progress.emit(int(fraction * 100))
+
+
+class TraceStoreThread(QThread):
+    """builds the trace store, or rebuilds it if the traces have changed,
+    store_finished is emitted with an empty message when done, otherwise
+    with the reason it was not
+    """
+
+    store_progress = pyqtSignal(int)
+    store_finished = pyqtSignal(str)
+
+    def __init__(self, db_tools: DbTools, rebuild: bool):
         super().__init__()
         self.db_tools = db_tools
+        self.rebuild = rebuild
+
+    def run(self):
+        message = "Building the trace store failed, see the log"
+        try:
+            cancelled = self.isInterruptionRequested
+            if self.rebuild:
+                done = self.db_tools.build_trace_store(
+                    self.emit_progress, cancelled=cancelled
+                )
+
+            else:
+                # None if the database could not be read, False if current
+                done = (
+                    self.db_tools.sync_trace_store(
+                        self.emit_progress, cancelled=cancelled
+                    )
+                    is not None
+                )
+
+            if done:
+                message = ""
+
+        except BinningCancelled:
+            message = "Building the trace store cancelled"
+
+        except Exception as error:
+            print(f"error: trace store: {error!r}")
+            message = f"Building the trace store failed: {error}"
+
+        finally:
+            self.db_tools.release_connection()
+            self.store_finished.emit(message)
+
+    def emit_progress(self, fraction: float):
+        self.store_progress.emit(int(fraction * 100))
+
+
+class ExportThread(QThread):
+    export_progress = pyqtSignal(int, int)
+    export_finished = pyqtSignal(int, str)
+
+    def __init__(
+        self, db_filename: Path, out_folder: Path, every_nth: int, max_fold: int
+    ):
+        super().__init__()
+        self.db_filename = db_filename
+        self.out_folder = out_folder
+        self.every_nth = every_nth
+        self.max_fold = max_fold
+
+    def run(self):
+        exported, message = 0, ""
+        try:
+            bin_export = BinExport(
+                self.db_filename,
+                self.out_folder,
+                every_nth=self.every_nth,
+                max_fold=self.max_fold,
+            )
+            exported = bin_export.export(
+                progress=self.export_progress.emit,
+                cancelled=self.isInterruptionRequested,
+            )
+
+        except Exception as error:
+            print(f"error: {error}")
+            message = f"Export failed: {error}"
+
+        finally:
+            self.export_finished.emit(exported, message)
+
+
+class BinLoaderThread(QThread):
+    """queries the bins around the center bin and prepares the bin values
+    outside the GUI thread, the result is emitted with the request id so the
+    view can discard results of stale requests. bins_failed is emitted with
+    the error if the bins could not be loaded
+    """
+
+    bins_loaded = pyqtSignal(int, object)
+    bins_failed = pyqtSignal(int, str)
+
+    def __init__(
+        self,
+        request_id: int,
+        db_filename: Path,
+        center_bin: tuple[int, int],
+        offset: float,
+        src_indexes: list[int],
+        bin_cache: BinCache,
+    ):
+        super().__init__()
+        self.request_id = request_id
+        self.db_filename = db_filename
+        self.center_bin = center_bin
+        self.offset = offset
+        self.src_indexes = src_indexes
+        self.bin_cache = bin_cache
+
+    def run(self):
+        ba = None
+        try:
+            ba = BinAttributes(
+                self.db_filename,
+                self.center_bin,
+                self.offset,
+                self.src_indexes,
+                radius=BIN_RADIUS,
+                bin_cache=self.bin_cache,
+            )
+            bins_df = ba.get_surrounding_bins()
+
+        except Exception as error:
+            print(f"error: loading bin {self.center_bin}: {error!r}")
+            self.bins_failed.emit(self.request_id, str(error))
+            return
+
+        finally:
+            if ba:
+                ba.close()
+
+        if self.isInterruptionRequested():
+            return
+
+        for bin_df in bins_df.flat:
+            rose_histogram(bin_df, self.offset)
+
+        bin_values = Plot(bins_df).calc_bin_values(0, 0)
+        if self.isInterruptionRequested():
+            return
+
+        self.bins_loaded.emit(
+            self.request_id,
+            {
+                "center_bin": self.center_bin,
+                "offset": self.offset,
+                "src_indexes": self.src_indexes,
+                "bins_df": bins_df,
+                "bin_values": bin_values,
+            },
+        )
+
+
+class PrefetchThread(QThread):
+    """warms the bin cache with the bins next in the direction of travel"""
+
+    def __init__(
+        self,
+        db_filename: Path,
+        bins: list[tuple[int, int]],
+        offset: float,
+        src_indexes: list[int],
+        bin_cache: BinCache,
+    ):
+        super().__init__()
+        self.db_filename = db_filename
+        self.bins = bins
         self.offset = offset
         self.src_indexes = src_indexes
+        self.bin_cache = bin_cache
+
+    def run(self):
+        ba = None
+        try:
+            ba = BinAttributes(
+                self.db_filename,
+                self.bins[0],
+                self.offset,
+                self.src_indexes,
+                bin_cache=self.bin_cache,
+            )
+            ba.prefetch_bins(self.bins)
+
+        except Exception as error:
+            # prefetching is only to warm the cache
+            print(f"error: prefetching bins: {error!r}")
+
+        finally:
+            if ba:
+                ba.close()
+
+
+class ConfigWriteThread(QThread):
+    def __init__(self, db_tools: DbTools, values: dict[str, str]):
+        super().__init__()
+        self.db_tools = db_tools
+        self.values = values
+        self.written = False
 
     def run(self):
-        self.db_tools.clear_bins()
-        self.db_tools.bin_traces(self.offset, self.src_indexes)
-        self.binning_finished.emit()
+        self.written = self.db_tools.update_seis_config_values(self.values)
+        self.db_tools.release_connection()
+
+
+class SettingsWriter(QObject):
+    """writes settings to seis_config only when they have changed, writes are
+    coalesced by a debounce timer and done in a worker thread. Values are
+    only taken as written when the write succeeded, a failed write, for
+    example while binning holds the database lock, is retried
+    """
+
+    def __init__(self, db_tools: DbTools, values: dict[str, str], parent=None):
+        super().__init__(parent)
+        self.db_tools = db_tools
+        self.written = dict(values)
+        self.pending = {}
+        self.worker = None
+        self.write_timer = QTimer(self)
+        self.write_timer.setSingleShot(True)
+        self.write_timer.timeout.connect(self.write)
+
+    def set_values(self, values: dict[str, str]):
+        # compared with the values being written, so going back to a value
+        # while another is written is still written
+        written = {**self.written, **(self.worker.values if self.worker else {})}
+        for key, value in values.items():
+            if written.get(key) == value:
+                self.pending.pop(key, None)
+
+            else:
+                self.pending[key] = value
+
+        if self.pending:
+            self.write_timer.start(CONFIG_WRITE_DELAY)
+
+        else:
+            self.write_timer.stop()
+
+    def write(self):
+        if not self.pending:
+            return
+
+        # the result of the previous write is only known once its finished
+        # signal is handled, also when it is no longer running
+        if self.worker is not None:
+            self.write_timer.start(CONFIG_WRITE_DELAY)
+            return
+
+        self.worker = ConfigWriteThread(self.db_tools, self.pending)
+        self.worker.finished.connect(partial(self.on_write_finished, self.worker))
+        self.pending = {}
+        self.worker.start()
+
+    def on_write_finished(self, worker: ConfigWriteThread | None = None):
+        # also called from flush, the finished signal of a worker that flush
+        # has handled arrives after
+        if not self.worker or worker not in (None, self.worker):
+            return
+
+        self.worker.wait()
+        if self.worker.written:
+            self.written.update(self.worker.values)
+
+        else:
+            # values changed since the write are newer than the failed ones
+            self.pending = {**self.worker.values, **self.pending}
+            self.write_timer.start(CONFIG_WRITE_DELAY)
+
+        self.worker.deleteLater()
+        self.worker = None
+
+    def flush(self) -> bool:
+        """write pending settings immediately, blocking until written.
+        Returns False if the settings could not be written
+        """
+        self.write_timer.stop()
+        self.on_write_finished()
+        if self.pending:
+            if not self.db_tools.update_seis_config_values(self.pending):
+                self.write_timer.start(CONFIG_WRITE_DELAY)
+                return False
+
+            self.written.update(self.pending)
+            self.pending = {}
+
+        return True
 
 
 class MplCanvas(FigureCanvas):
+    """canvas that only draws when visible, a draw requested while hidden is
+    done when the canvas is shown
+    """
+
     def __init__(self, fig: matplotlib.figure.Figure):
         super().__init__(fig)
+        self.draw_deferred = False
+
+    def draw_idle(self):
+        if self.isVisible():
+            super().draw_idle()
+
+        else:
+            self.draw_deferred = True
+
+    def showEvent(self, event):
+        super().showEvent(event)
+        if self.draw_deferred:
+            self.draw_deferred = False
+            super().draw_idle()
 
 
 class BinAttributesView(QtWidgets.QMainWindow):
@@ -84,6 +514,8 @@ class BinAttributesView(QtWidgets.QMainWindow):
                 "layout": self.FormLayout_01,
                 "file_name": "bin_offset",
                 "fig": None,
+                "plot": None,
+                "bin_key": None,
             },
             "Spider": {
                 "index": 2,
@@ -92,6 +524,8 @@ class BinAttributesView(QtWidgets.QMainWindow):
                 "layout": self.FormLayout_02,
                 "file_name": "bin_spider",
                 "fig": None,
+                "plot": None,
+                "bin_key": None,
             },
             "Rose": {
                 "index": 3,
@@ -100,24 +534,42 @@ class BinAttributesView(QtWidgets.QMainWindow):
                 "layout": self.FormLayout_03,
                 "file_name": "bin_rose",
                 "fig": None,
+                "plot": None,
+                "bin_key": None,
             },
         }
         self.db_filename = Path(db_filename)
         self.bins_file_stem = self.db_filename.parent / self.db_filename.stem
         self.db_tools = DbTools(db_filename)
-        self.config = self.db_tools.get_config_from_db()
+        self.config = self.db_tools.config
+        self.bin_cache = BinCache()
+        self.settings = SettingsWriter(
+            self.db_tools,
+            {
+                "offset": str(self.config.offset),
+                "src_indexes": f"{", ".join(str(i) for i in self.config.src_indexes)}",
+            },
+            parent=self,
+        )
         self.save_folder_description = "Save to: "
         self.ActionQuit.triggered.connect(self.quit)
         self.ActionSaveFolder.triggered.connect(self.select_save_folder)
         self.ActionSave.triggered.connect(partial(self.save_plots))
+        self.ActionExport.triggered.connect(self.export_bins)
+        self.ActionTraceStore.triggered.connect(self.toggle_trace_store)
+        self.ActionClusterTraces.triggered.connect(self.cluster_traces)
         self.LineEdit_01.returnPressed.connect(self.select_bin)
         self.LineEdit_06.returnPressed.connect(self.select_bin)
         self.LineEdit_07.returnPressed.connect(self.select_bin)
         self.BinButton.pressed.connect(self.bin_traces)
         self.BinButton.setStyleSheet(button_syle)
-        self.resize_timer = QTimer()
-        self.resize_timer.setSingleShot(True)
-        self.resize_timer.timeout.connect(self.handle_resize_release)
+        self.IndexButton.pressed.connect(self.create_indexes)
+        self.IndexButton.setStyleSheet(button_syle)
+        self.ActionEngineFoldCube.setData("fold_cube")
+        self.ActionEngineSql.setData("sql")
+        self.ActionEngineIncremental.setData("incremental")
+        self.ActionEngineNumpy.setData("numpy")
+        self.ActionEngineParallel.setData("parallel")
 
         for _, value in self.plot_dict.items():
             value["rb"].clicked.connect(partial(self.show_plot, value["index"] - 1))
@@ -133,10 +585,26 @@ class BinAttributesView(QtWidgets.QMainWindow):
         self.LineEdit_04.setText("")
         self.LineEdit_05.setText("")
         self.LineEdit_06.setText(
-            f"{", ".join(str(i) for i in self.config["src_indexes"])}"
+            f"{", ".join(str(i) for i in self.config.src_indexes)}"
         )
-        self.LineEdit_07.setText(f"{int(self.config["offset"])}")
+        self.LineEdit_07.setText(f"{int(self.config.offset)}")
         self.bins_df = np.array([])
+        self.bin_key = None
+        self.bin_values = None
+        self.request_id = 0
+        self.bin_loaders = set()
+        self.previous_center_bin = None
+        self.prefetch_worker = None
+        self.export_worker = None
+        self.store_worker = None
+        self.cluster_worker = None
+        self.binning_worker = None
+        self.index_worker = None
+        self.update_actions()
+        if self.db_tools.has_trace_store():
+            self.ActionTraceStore.setChecked(True)
+            self.start_trace_store(rebuild=False)
+
         self.select_bin()
         self.show()
 
@@ -154,7 +622,7 @@ class BinAttributesView(QtWidgets.QMainWindow):
 
         indexes = self.LineEdit_06.text()
         for delimeter in ["/", ",", ";"]:
-            self.src_indexes = indexes.replace(delimeter, " ")
+            indexes = indexes.replace(delimeter, " ")
         try:
             self.src_indexes = [int(v) for v in indexes.split()]
             if not self.src_indexes or not all(v > 0 for v in self.src_indexes):
@@ -172,31 +640,126 @@ class BinAttributesView(QtWidgets.QMainWindow):
         except ValueError:
             return
 
-        self.db_tools.update_seis_config("offset", str(self.offset))
-        self.db_tools.update_seis_config(
-            "src_indexes", f"{", ".join(str(i) for i in self.src_indexes)}"
+        self.settings.set_values(
+            {
+                "offset": str(self.offset),
+                "src_indexes": f"{", ".join(str(i) for i in self.src_indexes)}",
+            }
+        )
+        self.load_bins((bin_src, bin_rcv))
+
+    def set_bin(self, bin_id: str):
+        self.LineEdit_01.setText(bin_id)
+        self.select_bin()
+
+    def load_bins(self, center_bin: tuple[int, int]):
+        """start loading the bins in a worker thread, a request still in
+        progress is cancelled
+        """
+        for loader in self.bin_loaders:
+            loader.requestInterruption()
+
+        self.request_id += 1
+        loader = BinLoaderThread(
+            self.request_id,
+            self.db_filename,
+            center_bin,
+            self.offset,
+            self.src_indexes,
+            self.bin_cache,
         )
+        loader.bins_loaded.connect(self.on_bins_loaded)
+        loader.bins_failed.connect(self.on_bins_failed)
+        loader.finished.connect(partial(self.on_loader_finished, loader))
+        self.bin_loaders.add(loader)
+        self.statusbar.showMessage(f"Loading bin {center_bin[0]}, {center_bin[1]} ...")
+        loader.start()
+
+    def on_loader_finished(self, loader: BinLoaderThread):
+        self.bin_loaders.discard(loader)
+        loader.deleteLater()
+
+    def on_bins_failed(self, request_id: int, message: str):
+        if request_id != self.request_id:
+            return
+
+        self.statusbar.showMessage(f"Loading bin failed: {message}")
+
+    def on_bins_loaded(self, request_id: int, result: dict):
+        if request_id != self.request_id:
+            return
+
+        self.statusbar.clearMessage()
+        bin_src, bin_rcv = result["center_bin"]
         self.center_bin_name = f"{bin_src}, {bin_rcv}"
-        ba = BinAttributes(
-            self.db_filename, (bin_src, bin_rcv), self.offset, self.src_indexes
+        self.offset = result["offset"]
+        self.src_indexes = result["src_indexes"]
+        self.bins_df = result["bins_df"]
+        self.bin_key = (
+            result["center_bin"],
+            self.offset,
+            tuple(self.src_indexes),
         )
-        self.bins_df = ba.get_surrounding_bins()
+        self.bin_values = result["bin_values"]
         self.create_attribute_figs()
-        del ba
+        self.prefetch_bins(result["center_bin"])
+
+    def prefetch_bins(self, center_bin: tuple[int, int]):
+        """prefetch the ring of bins next to the neighbourhood in the direction
+        the center bin moved, only when moved to a nearby bin
+        """
+        previous_center_bin = self.previous_center_bin
+        self.previous_center_bin = center_bin
+        if previous_center_bin is None:
+            return
+
+        step = np.array(center_bin) - np.array(previous_center_bin)
+        if not 0 < np.abs(step).max() <= PREFETCH_MAX_STEP:
+            return
+
+        if self.prefetch_worker and self.prefetch_worker.isRunning():
+            return
+
+        next_center_bin = np.array(center_bin) + np.sign(step)
+        r = BIN_RADIUS
+        current_bins = {
+            (center_bin[0] + i, center_bin[1] + j)
+            for i in range(-r, r + 1)
+            for j in range(-r, r + 1)
+        }
+        bins = [
+            (int(next_center_bin[0] + i), int(next_center_bin[1] + j))
+            for i in range(-r, r + 1)
+            for j in range(-r, r + 1)
+        ]
+        bins = [
+            bin
+            for bin in bins
+            if bin not in current_bins and bin[0] >= 1 and bin[1] >= 1
+        ]
+        if not bins:
+            return
+
+        self.prefetch_worker = PrefetchThread(
+            self.db_filename, bins, self.offset, self.src_indexes, self.bin_cache
+        )
+        self.prefetch_worker.finished.connect(
+            partial(self.on_prefetch_finished, self.prefetch_worker)
+        )
+        self.prefetch_worker.start()
+
+    def on_prefetch_finished(self, worker: PrefetchThread):
+        # a next prefetch can start before the finished signal of the previous
+        # one is handled, only that worker is deleted
+        worker.deleteLater()
+        if worker is self.prefetch_worker:
+            self.prefetch_worker = None
 
     def create_attribute_figs(self):
         if self.bins_df.size == 0:
             return
 
-        width = self.PlotFrame.width() / self.PlotFrame.logicalDpiX()
-        height = self.PlotFrame.height() / self.PlotFrame.logicalDpiY()
-        figsize = (width, height) if height > 1 else FIGSIZE_PYQT_PLOT
-        self.plt_offset = PlotOffset(self.bins_df, figsize)
-        self.plt_spider = PlotSpider(self.bins_df, self.offset, figsize)
-        self.plt_rose = PlotRose(self.bins_df, self.offset, figsize)
-        bin_line, bin_point, easting, northing, traces = (
-            self.plt_offset.calc_bin_values(0, 0)
-        )
+        bin_line, bin_point, easting, northing, traces = self.bin_values
         self.LineEdit_01.setText(self.center_bin_name)
         self.LineEdit_02.setText(f"{easting:.0f}")
         self.LineEdit_03.setText(f"{northing:.0f}")
@@ -204,57 +767,176 @@ class BinAttributesView(QtWidgets.QMainWindow):
         self.LineEdit_05.setText(f"{traces}")
         self.LineEdit_06.setText(f"{", ".join(str(i) for i in self.src_indexes)}")
         self.LineEdit_07.setText(f"{int(self.offset)}")
-        figure_dict = {}
-        figure_dict["Offset"] = self.plt_offset.diagram()
-        figure_dict["Spider"] = self.plt_spider.diagram()
-        figure_dict["Rose"] = self.plt_rose.diagram()
         bin_loc_str = ", ".join([str(easting), str(northing)])
         self.selected_bin_changed.emit(bin_loc_str)
-        self.update_canvas_data(figure_dict)
-        del self.plt_offset
-        del self.plt_spider
-        del self.plt_rose
+        self.render_plot(self.visible_plot())
 
-    def update_canvas_data(self, figure_dict: dict):
+    def visible_plot(self) -> str:
+        plot_index = self.StackedPlots.currentIndex()
         for key, value in self.plot_dict.items():
-            value["fig"] = figure_dict.get(key)
-            if value["canvas"]:
-                value["canvas"].hide()
-                value["layout"].removeWidget(value["canvas"])
-                value["canvas"] = None
+            if value["index"] - 1 == plot_index:
+                return key
+
+    def render_plot(self, key: str):
+        """render the plot for the current bins, a plot is only rendered when
+        shown or saved and is kept until the bins change
+        """
+        value = self.plot_dict[key]
+        if self.bins_df.size == 0 or value["bin_key"] == self.bin_key:
+            return
+
+        if value["plot"] is None:
+            width = self.PlotFrame.width() / self.PlotFrame.logicalDpiX()
+            height = self.PlotFrame.height() / self.PlotFrame.logicalDpiY()
+            figsize = (width, height) if height > 1 else FIGSIZE_PYQT_PLOT
+            if key == "Offset":
+                value["plot"] = PlotOffset(self.bins_df, figsize)
+
+            elif key == "Spider":
+                value["plot"] = PlotSpider(self.bins_df, self.offset, figsize)
+
+            else:
+                value["plot"] = PlotRose(self.bins_df, self.offset, figsize)
 
-            if value["fig"]:
-                value["canvas"] = MplCanvas(value["fig"])
-                value["layout"].addWidget(value["canvas"])
+            value["fig"] = value["plot"].diagram()
+            value["plot"].enable_blit()
+            value["canvas"] = MplCanvas(value["fig"])
+            value["layout"].addWidget(value["canvas"])
+
+        elif key == "Offset":
+            value["plot"].update(self.bins_df)
+
+        else:
+            value["plot"].update(self.bins_df, self.offset)
+
+        value["bin_key"] = self.bin_key
 
     def show_plot(self, plot_index: int):
+        for key, value in self.plot_dict.items():
+            if value["index"] - 1 == plot_index:
+                self.render_plot(key)
+
         self.StackedPlots.setCurrentIndex(plot_index)
 
-    def resizeEvent(self, event):
-        self.resize_timer.start(MOUSE_RELEASE_TRIGGER)
-        super().resizeEvent(event)
+    def bin_traces(self):
+        """start binning, or cancel the binning when it is running, the bins
+        are then left as they were
+        """
+        if self.binning_worker:
+            self.binning_worker.requestInterruption()
+            self.BinButton.setText("Cancelling ...")
+            self.BinButton.setEnabled(False)
+            return
 
-    def handle_resize_release(self):
-        self.create_attribute_figs()
+        if not self.settings.flush():
+            self.statusbar.showMessage(SETTINGS_NOT_SAVED)
+            return
 
-    def bin_traces(self):
-        self.BinButton.setText("Binning ...")
+        self.BinButton.setText("Cancel binning")
         self.BinButton.setStyleSheet(button_style_active)
-        self.BinButton.setEnabled(False)
-        time.sleep(0.5)
-        self.config = self.db_tools.get_config_from_db()
-        self.worker = BinningThread(
-            self.db_tools, self.config["offset"], self.config["src_indexes"]
+        self.statusbar.showMessage("Binning ...")
+        self.config = self.db_tools.config
+        self.binning_worker = BinningThread(
+            self.db_tools,
+            self.config.offset,
+            self.config.src_indexes,
+            engine=self.BinningEngineGroup.checkedAction().data(),
         )
-        self.worker.binning_finished.connect(self.on_bin_traces_completion)
-        self.worker.start()
+        self.binning_worker.binning_progress.connect(self.on_bin_traces_progress)
+        self.binning_worker.binning_finished.connect(self.on_bin_traces_completion)
+        self.binning_worker.start()
+        self.update_actions()
 
-    def on_bin_traces_completion(self):
+    def on_bin_traces_progress(self, percentage: int, eta: float):
+        if eta < 0:
+            self.statusbar.showMessage(f"Binning ... {percentage}%")
+
+        else:
+            minutes, seconds = divmod(round(eta), 60)
+            eta = f"{minutes} min {seconds} s" if minutes else f"{seconds} s"
+            self.statusbar.showMessage(f"Binning ... {percentage}%, ETA {eta}")
+
+    def on_bin_traces_completion(self, message: str):
         self.BinButton.setText("Bin traces")
         self.BinButton.setStyleSheet(button_syle)
-        self.BinButton.setEnabled(True)
-        self.worker.deleteLater()
-        self.selected_bin_changed.emit("new_foldplot")
+        self.binning_worker.wait()
+        self.binning_worker.deleteLater()
+        self.binning_worker = None
+        self.update_actions()
+        if message:
+            self.statusbar.showMessage(message)
+
+        else:
+            self.statusbar.clearMessage()
+            self.selected_bin_changed.emit("new_foldplot")
+
+    def update_actions(self):
+        """binning, indexing, clustering, building the trace store and the
+        export all write or read all of the traces, so only one of them runs
+        at a time. While binning the bin button cancels the binning
+        """
+        busy = any(
+            (
+                self.binning_worker,
+                self.index_worker,
+                self.cluster_worker,
+                self.store_worker,
+                self.export_worker,
+            )
+        )
+        for action in (
+            self.ActionExport,
+            self.ActionTraceStore,
+            self.ActionClusterTraces,
+        ):
+            action.setEnabled(not busy)
+
+        if not self.binning_worker:
+            self.BinButton.setEnabled(not busy)
+
+        if busy:
+            self.IndexButton.setEnabled(False)
+
+        else:
+            self.show_index_health()
+
+    def show_index_health(self):
+        index_health = self.db_tools.get_index_health()
+        self.IndexLabel.setToolTip("")
+        if index_health is None:
+            self.IndexLabel.setText("Index: unknown, database error")
+            self.IndexButton.setEnabled(True)
+            return
+
+        missing = [name for name, index_ok in index_health.items() if not index_ok]
+        if missing:
+            # the label only fits a short text, the missing indexes are listed
+            # in the tooltip
+            self.IndexLabel.setText(f"Index: {len(missing)} missing")
+            self.IndexLabel.setToolTip(f"Index missing: {", ".join(missing)}")
+            self.IndexButton.setEnabled(True)
+
+        else:
+            self.IndexLabel.setText("Index: ok")
+            self.IndexButton.setEnabled(False)
+
+    def create_indexes(self):
+        self.IndexButton.setStyleSheet(button_style_active)
+        self.index_worker = IndexThread(self.db_tools)
+        self.index_worker.index_progress.connect(self.on_index_progress)
+        self.index_worker.index_finished.connect(self.on_index_completion)
+        self.index_worker.start()
+        self.update_actions()
+
+    def on_index_progress(self, percentage: int):
+        self.IndexLabel.setText(f"Indexing ... {percentage}%")
+
+    def on_index_completion(self):
+        self.IndexButton.setStyleSheet(button_syle)
+        self.index_worker.wait()
+        self.index_worker.deleteLater()
+        self.index_worker = None
+        self.update_actions()
 
     def select_save_folder(self):
         save_folder = QtWidgets.QFileDialog.getExistingDirectory(
@@ -271,8 +953,9 @@ class BinAttributesView(QtWidgets.QMainWindow):
 
     def save_plots(self):
         base_file_name = "".join([datetime.datetime.now().strftime("%y%m%d"), "_"])
-        for _, value in self.plot_dict.items():
-            if not (fig := value["fig"]):
+        for key, value in self.plot_dict.items():
+            self.render_plot(key)
+            if not (plot := value["plot"]):
                 continue
 
             file_name = self.save_folder / "".join(
@@ -284,9 +967,144 @@ class BinAttributesView(QtWidgets.QMainWindow):
                     ".png",
                 ]
             )
-            fig.savefig(file_name)
+            plot.savefig(file_name)
+
+    def export_bins(self):
+        """export the plots of every nth bin and/ or bins up to a max fold in a
+        background process pool, a next export of the same bins resumes with
+        the bins not yet exported
+        """
+        if self.export_worker:
+            return
+
+        every_nth, ok = QtWidgets.QInputDialog.getInt(
+            self, "Export bins", "Export every nth bin", EXPORT_EVERY_NTH, 1
+        )
+        if not ok:
+            return
+
+        max_fold, ok = QtWidgets.QInputDialog.getInt(
+            self, "Export bins", "Max fold (0 for all bins)", 0, 0
+        )
+        if not ok:
+            return
+
+        if not self.settings.flush():
+            self.statusbar.showMessage(SETTINGS_NOT_SAVED)
+            return
+
+        self.export_worker = ExportThread(
+            self.db_filename,
+            self.save_folder / EXPORT_FOLDER,
+            every_nth,
+            max_fold or None,
+        )
+        self.export_worker.export_progress.connect(self.on_export_progress)
+        self.export_worker.export_finished.connect(self.on_export_completion)
+        self.statusbar.showMessage("Exporting bins ...")
+        self.export_worker.start()
+        self.update_actions()
+
+    def on_export_progress(self, done: int, total: int):
+        self.statusbar.showMessage(f"Exporting bins ... {done}/ {total}")
+
+    def on_export_completion(self, exported: int, message: str):
+        self.statusbar.showMessage(
+            message or f"Exported {exported} bins to {self.save_folder / EXPORT_FOLDER}"
+        )
+        self.export_worker.wait()
+        self.export_worker.deleteLater()
+        self.export_worker = None
+        self.update_actions()
+
+    def cluster_traces(self):
+        """rewrite the traces ordered by bin, so the traces of the bins around
+        a bin are read from a few runs of consecutive pages
+        """
+        self.cluster_worker = ClusterThread(self.db_tools)
+        self.cluster_worker.cluster_progress.connect(self.on_cluster_progress)
+        self.cluster_worker.cluster_finished.connect(self.on_cluster_completion)
+        self.statusbar.showMessage("Clustering traces ...")
+        self.cluster_worker.start()
+        self.update_actions()
+
+    def on_cluster_progress(self, percentage: int):
+        self.statusbar.showMessage(f"Clustering traces ... {percentage}%")
+
+    def on_cluster_completion(self, message: str):
+        self.cluster_worker.wait()
+        self.cluster_worker.deleteLater()
+        self.cluster_worker = None
+        self.update_actions()
+        if message:
+            self.statusbar.showMessage(message)
+
+        else:
+            self.statusbar.clearMessage()
+
+    def toggle_trace_store(self, checked: bool):
+        """build a bin sorted columnar copy of the traces next to the database,
+        the plots and the numpy engine read the traces from the store
+        """
+        if checked:
+            self.start_trace_store(rebuild=True)
+
+        else:
+            self.db_tools.remove_trace_store()
+            self.statusbar.showMessage("Trace store removed")
+
+    def start_trace_store(self, rebuild: bool):
+        self.store_worker = TraceStoreThread(self.db_tools, rebuild)
+        self.store_worker.store_progress.connect(self.on_trace_store_progress)
+        self.store_worker.store_finished.connect(self.on_trace_store_completion)
+        self.store_worker.start()
+        self.update_actions()
+
+    def on_trace_store_progress(self, percentage: int):
+        self.statusbar.showMessage(f"Building trace store ... {percentage}%")
+
+    def on_trace_store_completion(self, message: str):
+        self.ActionTraceStore.setChecked(self.db_tools.has_trace_store())
+        self.store_worker.wait()
+        self.store_worker.deleteLater()
+        self.store_worker = None
+        self.update_actions()
+        if message:
+            self.statusbar.showMessage(message)
+
+        else:
+            self.statusbar.clearMessage()
 
     def closeEvent(self, event):
+        if self.binning_worker:
+            self.binning_worker.requestInterruption()
+            self.binning_worker.wait()
+
+        if self.index_worker:
+            self.index_worker.requestInterruption()
+            self.index_worker.wait()
+
+        if self.store_worker:
+            self.store_worker.requestInterruption()
+            self.store_worker.wait()
+
+        if self.cluster_worker:
+            self.cluster_worker.requestInterruption()
+            self.cluster_worker.wait()
+
+        if self.export_worker:
+            self.export_worker.requestInterruption()
+            self.export_worker.wait()
+
+        for loader in self.bin_loaders:
+            loader.requestInterruption()
+            loader.wait()
+
+        if self.prefetch_worker:
+            self.prefetch_worker.wait()
+
+        self.settings.flush()
+        self.db_tools.close()
         self.selected_bin_changed.emit("quit")
 
     def quit(self):
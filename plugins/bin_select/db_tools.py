@@ -1,6 +1,133 @@
 from pathlib import Path
+import math
 import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import as_completed
+from dataclasses import dataclass
 from functools import wraps
+from itertools import chain
+import numpy as np
+from .mp_tools import get_workers, process_pool
+from .trace_store import TraceStore, get_traces_signature, install_traces_version
+
+BINNED_KEYS = ["binned_offset", "binned_src_indexes", "binned_traces"]
+FOLD_CUBE_KEYS = ["fold_cube_class_width", "fold_cube_traces"]
+BIN_DIRECTORY_KEY = "bin_directory_traces"
+SEIS_CONFIG_UPSERT = "INSERT OR REPLACE INTO seis_config (key, value) VALUES (?, ?);"
+OFFSET_CLASS_WIDTH = 50.0
+TRACES_INDEXES = {
+    "idx_traces_bin": ("bin_sp", "bin_rp", "src_index", "offset"),
+    "idx_traces_offset": ("offset", "src_index", "bin_sp", "bin_rp"),
+}
+INDEX_STEPS_PER_ROW = 13
+CLUSTER_STEPS_PER_ROW = 54
+BIN_STEPS_PER_ROW = 17
+DELTA_STEPS_PER_ROW = 46
+FOLD_CUBE_STEPS_PER_ROW = 40
+FOLD_CUBE_BIN_STEPS_PER_ROW = 8
+CLEAR_STEPS_PER_BIN = 9
+UPDATE_STEPS_PER_BIN = 30
+NUMPY_STEPS_PER_ROW = 40
+STORE_COUNT_STEPS_PER_ROW = 2
+STORE_STEPS_PER_ROW = 130
+PROGRESS_STEPS = 100_000
+NUMPY_CHUNK_SIZE = 1_000_000
+UPDATE_CHUNK_SIZE = 50_000
+PARTITION_ROWS = 2_000_000
+FOLD_COLUMNS = ("bin_sp", "bin_rp", "offset", "src_index")
+BINNING_ENGINES = {
+    "fold_cube": "bin_traces_fold_cube",
+    "sql": "bin_traces",
+    "incremental": "bin_traces_incremental",
+    "numpy": "bin_traces_numpy",
+    "parallel": "bin_traces_parallel",
+}
+
+
+@dataclass
+class SeisConfig:
+    file_stem: str
+    azimuth: float
+    easting_orig: float
+    northing_orig: float
+    bin_sp_int: float
+    bin_rp_int: float
+    nb_bin_sp: int
+    nb_bin_rp: int
+    epsg: int
+    offset: float
+    src_indexes: list[int]
+
+    @classmethod
+    def from_values(cls, values: dict[str, str]) -> "SeisConfig":
+        return cls(
+            file_stem=values["file_stem"],
+            azimuth=float(values["azimuth"]),
+            easting_orig=float(values["easting_orig"]),
+            northing_orig=float(values["northing_orig"]),
+            bin_sp_int=float(values["bin_sp_int"]),
+            bin_rp_int=float(values["bin_rp_int"]),
+            nb_bin_sp=int(float(values["nb_bin_sp"])),
+            nb_bin_rp=int(float(values["nb_bin_rp"])),
+            epsg=int(float(values["epsg"])),
+            offset=float(values["offset"]),
+            src_indexes=[int(v) for v in values["src_indexes"].split(",")],
+        )
+
+
+class ConnectionPool:
+    """keeps sqlite connections with spatialite loaded alive per database and
+    per thread, as a connection may only be used by one thread at the time
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+
+    def get_connection(self, database) -> sqlite3.Connection:
+        key = (str(database), threading.get_ident())
+        with self.lock:
+            connection = self.connections.get(key)
+
+        if connection is None:
+            # a thread id can be reused after a thread has finished, so the
+            # connection is not bound to the thread that created it
+            connection = sqlite3.connect(database, check_same_thread=False)
+            try:
+                connection.enable_load_extension(True)
+                connection.execute('SELECT load_extension("mod_spatialite")')
+
+            except sqlite3.Error:
+                connection.close()
+                raise
+
+            with self.lock:
+                self.connections[key] = connection
+
+        return connection
+
+    def release(self, database) -> None:
+        """close the connection of the current thread"""
+        key = (str(database), threading.get_ident())
+        with self.lock:
+            connection = self.connections.pop(key, None)
+
+        if connection:
+            connection.close()
+
+    def close(self, database) -> None:
+        """close the connections of all threads"""
+        with self.lock:
+            keys = [key for key in self.connections if key[0] == str(database)]
+            connections = [self.connections.pop(key) for key in keys]
+
+        for connection in connections:
+            connection.close()
+
+
+connection_pool = ConnectionPool()
 
 
 def db_connect(func):
@@ -8,81 +135,927 @@ def db_connect(func):
     def wrapper(*args, **kwargs):
         result = None
         database = args[0].database_file
+        connection = None
+        cursor = None
         try:
-            connection = sqlite3.connect(database)
-            connection.enable_load_extension(True)
-            connection.execute('SELECT load_extension("mod_spatialite")')
+            connection = connection_pool.get_connection(database)
             cursor = connection.cursor()
             result = func(*args, cursor, **kwargs)
             connection.commit()
 
         except sqlite3.Error as error:
             print(f"Error while connect to sqlite {database}: {error}")
+            if connection:
+                connection.rollback()
 
-        finally:
+        except BaseException:
+            # the pooled connection is reused, it must not be left in a
+            # transaction that holds the database lock
             if connection:
+                connection.rollback()
+
+            raise
+
+        finally:
+            if cursor:
                 cursor.close()
-                connection.close()
 
         return result
 
     return wrapper
 
 
+class BinningCancelled(Exception):
+    """raised by a binning engine when the binning is cancelled, the changes
+    to the bins are rolled back. Also raised when indexing, clustering or
+    building the trace store is cancelled
+    """
+
+
+class BinningPhases:
+    """progress of a binning over its phases, the weight of a phase is its
+    estimated number of virtual machine steps (or the equivalent for numpy).
+    progress is called with the fraction done of the binning, cancelled is
+    polled on each update and BinningCancelled is raised when it returns True.
+    The time of each phase is logged when the binning finishes or is cancelled
+    """
+
+    def __init__(self, engine, weights, progress=None, cancelled=None):
+        self.engine = engine
+        self.weights = weights
+        self.total = max(1, sum(weights.values()))
+        self.progress = progress
+        self.cancelled = cancelled
+        self.phase = None
+        self.done = 0
+        self.times = {}
+        self.start_time = time.perf_counter()
+        self.phase_start = self.start_time
+
+    def start(self, phase):
+        self._end_phase()
+        self.phase = phase
+        self.phase_start = time.perf_counter()
+        self.update(0.0)
+
+    def update(self, fraction):
+        """fraction is the fraction done of the current phase"""
+        if self.cancelled and self.cancelled():
+            self._end_phase()
+            self._log("cancelled")
+            raise BinningCancelled(f"binning {self.engine} cancelled in {self.phase}")
+
+        if self.progress:
+            weight = self.weights.get(self.phase, 0)
+            self.progress(min(1.0, (self.done + weight * fraction) / self.total))
+
+    def execute(self, cursor, sql_string, parameters=()):
+        DbTools._execute_with_progress(
+            cursor,
+            sql_string,
+            max(1, self.weights.get(self.phase, 0)),
+            self.update,
+            parameters,
+        )
+
+    def track(self, chunks, rows):
+        # yields the chunks and updates the progress with the rows done
+        done = 0
+        for chunk in chunks:
+            yield chunk
+            done += len(chunk[0])
+            self.update(min(1.0, done / max(1, rows)))
+
+    def finish(self):
+        self._end_phase()
+        if self.progress:
+            self.progress(1.0)
+
+        self._log("total")
+
+    def _log(self, status):
+        times = [f"{phase} {t:.2f} s" for phase, t in self.times.items()]
+        times.append(f"{status} {time.perf_counter() - self.start_time:.2f} s")
+        print(f"binning {self.engine}: {", ".join(times)}", file=sys.stderr)
+
+    def _end_phase(self):
+        if self.phase is not None:
+            self.times[self.phase] = time.perf_counter() - self.phase_start
+            self.done += self.weights.get(self.phase, 0)
+
+
+def count_traces_partition(
+    database_file, rows, from_store, offset, indexes, nb_bin_sp, nb_bin_rp
+):
+    """count the selected traces per bin in a partition of the traces, rows is
+    the first and last rowid of the partition or the row range in the trace
+    store. The database is opened read only. Returns the linear index and
+    the count of the bins with traces
+    """
+    if from_store:
+        trace_store = TraceStore(database_file)
+        fold = DbTools._count_traces(
+            trace_store.chunks(FOLD_COLUMNS, start=rows[0], end=rows[1]),
+            offset,
+            indexes,
+            nb_bin_sp,
+            nb_bin_rp,
+        )
+        trace_store.close()
+
+    else:
+        uri = f"{Path(database_file).resolve().as_uri()}?mode=ro"
+        connection = sqlite3.connect(uri, uri=True)
+        try:
+            fold = DbTools._count_traces(
+                DbTools._get_traces_chunks(connection.cursor(), FOLD_COLUMNS, rows),
+                offset,
+                indexes,
+                nb_bin_sp,
+                nb_bin_rp,
+            )
+
+        finally:
+            connection.close()
+
+    bin_index = np.flatnonzero(fold)
+    return bin_index, fold.ravel()[bin_index]
+
+
 class DbTools:
     def __init__(self, database_file: Path):
         self.database_file = database_file
+        self._config = None
+        self._config_values = None
+        self.config_listeners = []
+
+    def release_connection(self):
+        """to be called by a thread when it is done with the database"""
+        connection_pool.release(self.database_file)
+
+    def close(self):
+        connection_pool.close(self.database_file)
+
+    @property
+    def config(self) -> SeisConfig:
+        """seis_config cached in memory, loaded with a single query on first use,
+        writes update the cached values so the config is not read again
+        """
+        if self._config_values is None:
+            self.get_config_from_db()
+
+        if self._config is None:
+            self._config = SeisConfig.from_values(self._config_values)
+
+        return self._config
+
+    def add_config_listener(self, listener) -> None:
+        """listener is called with a dict of the changed keys and values after
+        each write to seis_config
+        """
+        self.config_listeners.append(listener)
+
+    def remove_config_listener(self, listener) -> None:
+        if listener in self.config_listeners:
+            self.config_listeners.remove(listener)
+
+    def update_seis_config(self, key, value):
+        self.update_seis_config_values({key: value})
+
+    def update_seis_config_values(self, values: dict[str, str]) -> bool:
+        """write the values in a single transaction, invalidate the cached
+        config and notify the listeners. Returns False if the write failed
+        """
+        if not values:
+            return True
+
+        if not self._write_seis_config(values):
+            return False
+
+        if self._config_values is not None:
+            self._config_values.update(values)
+
+        self._config = None
+        for listener in list(self.config_listeners):
+            listener(values)
+
+        return True
+
+    @db_connect
+    def _write_seis_config(self, values, cursor):
+        cursor.executemany(SEIS_CONFIG_UPSERT, values.items())
+        return True
+
+    @db_connect
+    def get_config_from_db(self, cursor) -> SeisConfig:
+        self._config = self._get_config(cursor)
+        return self._config
+
+    @db_connect
+    def get_index_health(self, cursor):
+        """returns for each required index on traces if an index with its
+        columns (or starting with its columns) exists
+        """
+        return self._get_index_health(cursor)
+
+    @db_connect
+    def create_traces_indexes(self, progress, cursor, cancelled=None):
+        """create the missing indexes on traces, progress is called with the
+        estimated fraction done based on the number of virtual machine steps
+        sqlite takes per row. The index being created is rolled back when
+        cancelled returns True, the indexes already created are kept
+        """
+        total_steps = max(1, self._get_rows_estimate(cursor) * INDEX_STEPS_PER_ROW)
+        missing = [
+            name
+            for name, index_ok in self._get_index_health(cursor).items()
+            if not index_ok
+        ]
+        for done, name in enumerate(missing):
+
+            def index_progress(fraction, done=done):
+                progress((done + fraction) / len(missing))
+
+            self._execute_with_progress(
+                cursor,
+                f"CREATE INDEX IF NOT EXISTS {name} "
+                f"ON traces ({", ".join(TRACES_INDEXES[name])});",
+                total_steps,
+                index_progress if progress else None,
+                cancelled=cancelled,
+            )
+
+        if progress:
+            progress(1.0)
+
+    @staticmethod
+    def _get_rows_estimate(cursor):
+        min_rowid, max_rowid = cursor.execute(
+            "SELECT min(rowid), max(rowid) FROM traces;"
+        ).fetchone()
+        return max_rowid - min_rowid + 1 if max_rowid else 0
+
+    @staticmethod
+    def _execute_with_progress(
+        cursor, sql_string, total_steps, progress, parameters=(), cancelled=None
+    ):
+        # progress is estimated from the number of virtual machine steps, the
+        # statement is interrupted when progress raises BinningCancelled or
+        # when cancelled returns True
+        connection = cursor.connection
+        steps = 0
+        interrupted = None
+
+        def progress_handler():
+            nonlocal steps, interrupted
+            steps += PROGRESS_STEPS
+            try:
+                if cancelled and cancelled():
+                    raise BinningCancelled("cancelled")
+
+                if progress:
+                    progress(min(0.99, steps / total_steps))
+
+            except BinningCancelled as error:
+                interrupted = error
+                return 1
+
+            return 0
+
+        connection.set_progress_handler(progress_handler, PROGRESS_STEPS)
+        try:
+            cursor.execute(sql_string, parameters)
+
+        except sqlite3.OperationalError:
+            if interrupted:
+                raise interrupted from None
+
+            raise
+
+        finally:
+            connection.set_progress_handler(None, PROGRESS_STEPS)
+
+    def _get_index_health(self, cursor):
+        indexes = self._get_traces_indexes(cursor)
+        return {
+            name: any(
+                index_columns[: len(columns)] == columns
+                for index_columns in indexes.values()
+            )
+            for name, columns in TRACES_INDEXES.items()
+        }
+
+    @staticmethod
+    def _get_traces_indexes(cursor):
+        indexes = {}
+        for row in cursor.execute("PRAGMA index_list(traces);").fetchall():
+            name = row[1]
+            index_info = cursor.execute(f"PRAGMA index_info('{name}');").fetchall()
+            indexes[name] = tuple(
+                col[2] for col in sorted(index_info, key=lambda col: col[0])
+            )
+
+        return indexes
 
     @db_connect
-    def update_seis_config(self, key, value, cursor):
+    def get_traces_count(self, cursor):
+        return cursor.execute("SELECT count(*) FROM traces;").fetchone()[0]
+
+    @db_connect
+    def get_bins(self, every_nth, max_fold, cursor, include_empty=False):
+        """returns the bins (bin_sp, bin_rp) on a grid of every nth bin in both
+        directions, if max_fold is given only bins with a fold of at most
+        max_fold. Bins without traces, for example outside the survey, are
+        only included with include_empty, bins that are not binned have a fold
+        of 0
+        """
         sql_string = (
-            f"INSERT OR REPLACE INTO seis_config (key, value) " f"VALUES (?, ?);"
+            "SELECT bin_sp, bin_rp FROM bins "
+            "WHERE (bin_sp - 1) % ? = 0 AND (bin_rp - 1) % ? = 0 "
         )
-        cursor.execute(sql_string, (key, value))
+        parameters = [every_nth, every_nth]
+        if not include_empty:
+            sql_string += "AND bin_count > 0 "
+
+        if max_fold is not None:
+            sql_string += "AND IFNULL(bin_count, 0) <= ? "
+            parameters.append(max_fold)
+
+        sql_string += "ORDER BY bin_sp, bin_rp;"
+        return cursor.execute(sql_string, parameters).fetchall()
 
     @db_connect
-    def get_config_from_db(self, cursor):
-        sql_string = "select value from seis_config WHERE key = ?"
-        config = {}
-        config["file_stem"] = cursor.execute(sql_string, ("file_stem",)).fetchone()[0]
-        config["azimuth"] = float(
-            cursor.execute(sql_string, ("azimuth",)).fetchone()[0]
-        )
-        config["easting_orig"] = float(
-            cursor.execute(sql_string, ("easting_orig",)).fetchone()[0]
+    def get_traces_signature(self, cursor):
+        return self._get_traces_signature(cursor)
+
+    def cluster_traces(self, progress, cancelled=None):
+        """rewrite the traces table ordered by bin, so the traces of a bin
+        are in consecutive rows and pages, and build the bin directory with
+        the first row and the number of rows of each bin. The database is
+        vacuumed afterwards to release the pages of the old table. Returns
+        True if done, raises BinningCancelled when cancelled returns True, the
+        traces are then as they were or clustered but not vacuumed
+        """
+        try:
+            clustered = self._cluster_traces(progress, cancelled=cancelled)
+
+        except BinningCancelled:
+            self._drop_traces_clustered()
+            raise
+
+        return bool(clustered and self._vacuum(cancelled=cancelled))
+
+    @db_connect
+    def _drop_traces_clustered(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS traces_clustered;")
+
+    @db_connect
+    def _cluster_traces(self, progress, cursor, cancelled=None):
+        # the rows are renumbered in bin order, the rowid order is the order
+        # of the table b-tree. A WITHOUT ROWID table would also cluster by bin
+        # but has no rowid for the traces signature and row ranges
+        table_sql = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'traces';"
+        ).fetchone()[0]
+        index_sqls = [
+            row[0]
+            for row in cursor.execute(
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND "
+                "tbl_name = 'traces' AND sql IS NOT NULL;"
+            ).fetchall()
+        ]
+        # only a single column INTEGER PRIMARY KEY is the rowid, it is not
+        # copied so the rows are renumbered
+        table_info = cursor.execute("PRAGMA table_info(traces);").fetchall()
+        pk_columns = [row for row in table_info if row[5]]
+        rowid_column = (
+            pk_columns[0][1]
+            if len(pk_columns) == 1 and pk_columns[0][2].upper() == "INTEGER"
+            else None
         )
-        config["northing_orig"] = float(
-            cursor.execute(sql_string, ("northing_orig",)).fetchone()[0]
+        columns = ", ".join(row[1] for row in table_info if row[1] != rowid_column)
+        total_steps = max(1, self._get_rows_estimate(cursor) * CLUSTER_STEPS_PER_ROW)
+        cursor.execute("DROP TABLE IF EXISTS traces_clustered;")
+        cursor.execute(table_sql.replace("traces", "traces_clustered", 1))
+        self._execute_with_progress(
+            cursor,
+            f"INSERT INTO traces_clustered ({columns}) "
+            f"SELECT {columns} FROM traces ORDER BY bin_sp, bin_rp, rowid;",
+            total_steps,
+            progress,
+            cancelled=cancelled,
         )
-        config["bin_sp_int"] = float(
-            cursor.execute(sql_string, ("bin_sp_int",)).fetchone()[0]
+        cursor.execute("DROP TABLE traces;")
+        cursor.execute("ALTER TABLE traces_clustered RENAME TO traces;")
+        for index_sql in index_sqls:
+            self._execute_with_progress(cursor, index_sql, 1, None, cancelled=cancelled)
+
+        # the triggers that count the changes are dropped with the table, they
+        # are recreated with a new version so the fold cube, the binning and
+        # the trace store are out of date
+        install_traces_version(cursor)
+
+        self._build_bin_directory(cursor)
+        if progress:
+            progress(1.0)
+
+        return True
+
+    @db_connect
+    def _vacuum(self, cursor, cancelled=None):
+        self._execute_with_progress(cursor, "VACUUM;", 1, None, cancelled=cancelled)
+        return True
+
+    def _build_bin_directory(self, cursor):
+        cursor.execute("DROP TABLE IF EXISTS bin_directory;")
+        cursor.execute(
+            "CREATE TABLE bin_directory ("
+            "bin_sp INTEGER, bin_rp INTEGER, first_row INTEGER, row_count INTEGER, "
+            "PRIMARY KEY (bin_sp, bin_rp)) WITHOUT ROWID;"
         )
-        config["bin_rp_int"] = float(
-            cursor.execute(sql_string, ("bin_rp_int",)).fetchone()[0]
+        cursor.execute(
+            "INSERT INTO bin_directory "
+            "SELECT bin_sp, bin_rp, min(rowid), count(*) FROM traces "
+            "GROUP BY bin_sp, bin_rp;"
         )
-        config["nb_bin_sp"] = int(
-            float(cursor.execute(sql_string, ("nb_bin_sp",)).fetchone()[0])
+        cursor.execute(
+            SEIS_CONFIG_UPSERT, (BIN_DIRECTORY_KEY, self._get_traces_signature(cursor))
         )
-        config["nb_bin_rp"] = int(
-            float(cursor.execute(sql_string, ("nb_bin_rp",)).fetchone()[0])
+
+    @staticmethod
+    def bin_directory_is_current(cursor):
+        """True if the traces are clustered by bin and have not changed since"""
+        row = cursor.execute(
+            "SELECT value FROM seis_config WHERE key = ?;", (BIN_DIRECTORY_KEY,)
+        ).fetchone()
+        return bool(row) and row[0] == get_traces_signature(cursor)
+
+    @staticmethod
+    def get_row_ranges(cursor, bin_src_min, bin_src_max, bin_rcv_min, bin_rcv_max):
+        """the first and last row of the traces in the range of bins for each
+        source bin, the bins of a source bin are consecutive in clustered traces
+        """
+        sql_string = (
+            "SELECT min(first_row), max(first_row + row_count) - 1 "
+            "FROM bin_directory WHERE "
+            "bin_sp BETWEEN ? AND ? AND bin_rp BETWEEN ? AND ? "
+            "GROUP BY bin_sp ORDER BY bin_sp;"
         )
-        config["epsg"] = int(float(cursor.execute(sql_string, ("epsg",)).fetchone()[0]))
-        config["offset"] = float(cursor.execute(sql_string, ("offset",)).fetchone()[0])
-        config["src_indexes"] = [
-            int(v)
-            for v in cursor.execute(sql_string, ("src_indexes",))
-            .fetchone()[0]
-            .split(",")
-        ]
-        return config
+        return cursor.execute(
+            sql_string, (bin_src_min, bin_src_max, bin_rcv_min, bin_rcv_max)
+        ).fetchall()
 
     @db_connect
     def clear_bins(self, cursor):
         sql_string = "UPDATE bins SET bin_count = null;"
         cursor.execute(sql_string)
+        self._set_binned_parameters(cursor, None, None)
+
+    @db_connect
+    def bin_traces(self, offset, indexes, cursor, progress=None, cancelled=None):
+        phases = BinningPhases(
+            "sql",
+            {
+                "clear": self._get_bins_count(cursor) * CLEAR_STEPS_PER_BIN,
+                "bin": self._get_rows_estimate(cursor) * BIN_STEPS_PER_ROW,
+            },
+            progress,
+            cancelled,
+        )
+        phases.start("clear")
+        phases.execute(cursor, "UPDATE bins SET bin_count = null;")
+        self._bin_traces(cursor, offset, indexes, phases)
+        self._set_binned_parameters(cursor, offset, indexes)
+        phases.finish()
+        return True
 
     @db_connect
-    def bin_traces(self, offset, indexes, cursor):
+    def bin_traces_incremental(
+        self, offset, indexes, cursor, progress=None, cancelled=None
+    ):
+        """bin traces by only adjusting the counts of the traces that enter or
+        leave the selection since the last binning, full binning if there is
+        no previous binning or traces have changed since
+        """
+        rows = self._get_rows_estimate(cursor)
+        binned_offset, binned_indexes = self._get_binned_parameters(cursor)
+        if binned_offset is None:
+            phases = BinningPhases(
+                "incremental",
+                {
+                    "clear": self._get_bins_count(cursor) * CLEAR_STEPS_PER_BIN,
+                    "bin": rows * BIN_STEPS_PER_ROW,
+                },
+                progress,
+                cancelled,
+            )
+            phases.start("clear")
+            phases.execute(cursor, "UPDATE bins SET bin_count = null;")
+            self._bin_traces(cursor, offset, indexes, phases)
+
+        else:
+            phases = BinningPhases(
+                "incremental",
+                {"delta": rows * DELTA_STEPS_PER_ROW},
+                progress,
+                cancelled,
+            )
+            if binned_offset != float(offset) or set(binned_indexes) != set(indexes):
+                self._bin_traces_delta(
+                    cursor, offset, indexes, binned_offset, binned_indexes, phases
+                )
+
+        self._set_binned_parameters(cursor, offset, indexes)
+        phases.finish()
+        return True
+
+    @db_connect
+    def bin_traces_fold_cube(
+        self, offset, indexes, cursor, progress=None, cancelled=None
+    ):
+        """bin traces by summing the trace counts of the fold cube, the fold
+        cube is (re)built when it does not exist or traces have changed
+        """
+        rows = self._get_rows_estimate(cursor)
+        build_cube = not self._fold_cube_is_current(cursor)
+        phases = BinningPhases(
+            "fold_cube",
+            {
+                "build cube": build_cube * rows * FOLD_CUBE_STEPS_PER_ROW,
+                "clear": self._get_bins_count(cursor) * CLEAR_STEPS_PER_BIN,
+                "bin": rows * FOLD_CUBE_BIN_STEPS_PER_ROW,
+            },
+            progress,
+            cancelled,
+        )
+        if build_cube:
+            self._build_fold_cube(cursor, phases)
+
+        phases.start("clear")
+        phases.execute(cursor, "UPDATE bins SET bin_count = null;")
+        self._bin_fold_cube(cursor, offset, indexes, phases)
+        self._set_binned_parameters(cursor, offset, indexes)
+        phases.finish()
+        return True
+
+    @db_connect
+    def bin_traces_numpy(self, offset, indexes, cursor, progress=None, cancelled=None):
+        """bin traces by counting the selected traces per bin with numpy, the
+        traces are read in chunks so the survey does not need to fit in memory.
+        The traces are read from the trace store if there is one, it is rebuilt
+        first if the traces have changed
+        """
+        config = self._get_config(cursor)
+        rows = self._get_rows_estimate(cursor)
+        from_store, stale_store = self._get_store_state(cursor)
+        phases = BinningPhases(
+            "numpy",
+            self._get_count_weights(cursor, rows, from_store, stale_store),
+            progress,
+            cancelled,
+        )
+        if stale_store:
+            self._rebuild_store(cursor, config, phases)
+
+        phases.start("count")
+        if from_store:
+            chunks = TraceStore(self.database_file).chunks(FOLD_COLUMNS)
+
+        else:
+            chunks = self._get_traces_chunks(cursor, FOLD_COLUMNS)
+
+        fold = self._count_traces(
+            phases.track(chunks, rows),
+            offset,
+            indexes,
+            config.nb_bin_sp,
+            config.nb_bin_rp,
+        )
+        self._write_fold(cursor, fold, phases)
+        self._set_binned_parameters(cursor, offset, indexes)
+        phases.finish()
+        return True
+
+    @db_connect
+    def bin_traces_parallel(
+        self,
+        offset,
+        indexes,
+        cursor,
+        progress=None,
+        workers=None,
+        cancelled=None,
+    ):
+        """bin traces by counting partitions of the traces in a pool of
+        processes, each process reads its partition from the trace store or
+        from a read only connection. The partial folds are summed and written
+        in one update. The progress of the count is the fraction of the
+        partitions done
+        """
+        config = self._get_config(cursor)
+        nb_bins = config.nb_bin_sp * config.nb_bin_rp
+        from_store, stale_store = self._get_store_state(cursor)
+        phases = BinningPhases(
+            "parallel",
+            self._get_count_weights(
+                cursor,
+                self._get_rows_estimate(cursor),
+                from_store,
+                stale_store,
+                get_workers(workers),
+            ),
+            progress,
+            cancelled,
+        )
+        if stale_store:
+            self._rebuild_store(cursor, config, phases)
+
+        phases.start("count")
+        if from_store:
+            first_row, last_row = (
+                0,
+                TraceStore(self.database_file).get_info()["traces"] - 1,
+            )
+
+        else:
+            first_row, last_row = cursor.execute(
+                "SELECT min(rowid), max(rowid) FROM traces;"
+            ).fetchone()
+
+        partitions = []
+        if last_row is not None and last_row >= first_row:
+            nb_partitions = math.ceil((last_row - first_row + 1) / PARTITION_ROWS)
+            bounds = np.linspace(first_row, last_row + 1, nb_partitions + 1).astype(int)
+            partitions = [(int(a), int(b) - 1) for a, b in zip(bounds[:-1], bounds[1:])]
+
+        fold = np.zeros(nb_bins, dtype=np.int64)
+        if partitions:
+            with process_pool(min(get_workers(workers), len(partitions))) as executor:
+                futures = [
+                    executor.submit(
+                        count_traces_partition,
+                        self.database_file,
+                        rows,
+                        from_store,
+                        offset,
+                        indexes,
+                        config.nb_bin_sp,
+                        config.nb_bin_rp,
+                    )
+                    for rows in partitions
+                ]
+                try:
+                    for done, future in enumerate(as_completed(futures), start=1):
+                        bin_index, counts = future.result()
+                        fold[bin_index] += counts
+                        phases.update(done / len(partitions))
+
+                except BinningCancelled:
+                    # partitions not yet started are dropped, the running
+                    # partitions are waited for on leaving the executor
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    raise
+
+        self._write_fold(
+            cursor, fold.reshape(config.nb_bin_sp, config.nb_bin_rp), phases
+        )
+        self._set_binned_parameters(cursor, offset, indexes)
+        phases.finish()
+        return True
+
+    def _get_store_state(self, cursor):
+        # if there is a trace store and if it must be rebuilt as the traces
+        # have changed
+        trace_store = TraceStore(self.database_file)
+        if not trace_store.exists():
+            return False, False
+
+        return True, not trace_store.is_current(cursor)
+
+    def _rebuild_store(self, cursor, config, phases):
+        phases.start("store")
+        TraceStore(self.database_file).build(
+            cursor, config.nb_bin_sp, config.nb_bin_rp, progress=phases.update
+        )
+
+    def _get_count_weights(self, cursor, rows, from_store, stale_store, workers=1):
+        # phase weights of the engines that count the traces with numpy
+        nb_bins = self._get_bins_count(cursor)
+        steps_per_row = STORE_COUNT_STEPS_PER_ROW if from_store else NUMPY_STEPS_PER_ROW
+        return {
+            "store": stale_store * rows * STORE_STEPS_PER_ROW,
+            "count": rows * steps_per_row // workers,
+            "clear": nb_bins * CLEAR_STEPS_PER_BIN,
+            "update": nb_bins * UPDATE_STEPS_PER_BIN,
+        }
+
+    def _write_fold(self, cursor, fold, phases):
+        phases.start("clear")
+        phases.execute(cursor, "UPDATE bins SET bin_count = null;")
+        phases.start("update")
+        self._update_bin_counts(cursor, fold, phases.update)
+
+    @db_connect
+    def build_trace_store(self, progress, cursor, cancelled=None):
+        """build the bin sorted columnar trace store of the database, returns
+        True if done, raises BinningCancelled when cancelled returns True
+        """
+        self._build_trace_store(
+            cursor, TraceStore(self.database_file), progress, cancelled
+        )
+        return True
+
+    @db_connect
+    def sync_trace_store(self, progress, cursor, cancelled=None):
+        """rebuild the trace store if it exists and the traces have changed,
+        returns True if the store was rebuilt
+        """
+        trace_store = TraceStore(self.database_file)
+        if not trace_store.exists() or trace_store.is_current(cursor):
+            return False
+
+        self._build_trace_store(cursor, trace_store, progress, cancelled)
+        return True
+
+    def _build_trace_store(self, cursor, trace_store, progress, cancelled):
+        config = self._get_config(cursor)
+        nb_traces = trace_store.build(
+            cursor,
+            config.nb_bin_sp,
+            config.nb_bin_rp,
+            progress=progress,
+            cancelled=cancelled,
+        )
+        if nb_traces is None:
+            raise BinningCancelled("building the trace store cancelled")
+
+    def remove_trace_store(self):
+        TraceStore(self.database_file).remove()
+
+    def has_trace_store(self):
+        return TraceStore(self.database_file).exists()
+
+    @db_connect
+    def build_fold_cube(self, cursor, progress=None, cancelled=None):
+        phases = BinningPhases(
+            "fold_cube",
+            {"build cube": self._get_rows_estimate(cursor) * FOLD_CUBE_STEPS_PER_ROW},
+            progress,
+            cancelled,
+        )
+        self._build_fold_cube(cursor, phases)
+        phases.finish()
+        return True
+
+    def _fold_cube_is_current(self, cursor):
+        values = self._get_config_values(cursor)
+        if any(key not in values for key in FOLD_CUBE_KEYS):
+            return False
+
+        return float(values["fold_cube_class_width"]) == OFFSET_CLASS_WIDTH and (
+            values["fold_cube_traces"] == self._get_traces_signature(cursor)
+        )
+
+    def _build_fold_cube(self, cursor, phases):
+        # trace counts per bin, source index and offset class, the fold for
+        # any max offset is then the cumulative sum over the offset classes.
+        # The cube is stored in bin order, so it is summed per bin in a single
+        # scan without sorting
+        phases.start("build cube")
+        cursor.execute("DROP TABLE IF EXISTS fold_cube;")
+        cursor.execute(
+            "CREATE TABLE fold_cube ("
+            "bin_sp INTEGER, bin_rp INTEGER, src_index INTEGER, "
+            "offset_class INTEGER, trace_count INTEGER, "
+            "PRIMARY KEY (bin_sp, bin_rp, src_index, offset_class)) WITHOUT ROWID;"
+        )
+        sql_string = (
+            "INSERT INTO fold_cube "
+            "SELECT bin_sp, bin_rp, src_index, CAST(offset / ? AS INTEGER) AS oc, "
+            "count(*) "
+            "FROM traces tr NOT INDEXED "
+            "WHERE tr.offset >= 0 AND tr.bin_sp IS NOT NULL AND "
+            "tr.bin_rp IS NOT NULL AND tr.src_index IS NOT NULL "
+            "GROUP BY tr.bin_sp, tr.bin_rp, tr.src_index, oc;"
+        )
+        phases.execute(cursor, sql_string, (OFFSET_CLASS_WIDTH,))
+        values = [str(OFFSET_CLASS_WIDTH), self._get_traces_signature(cursor)]
+        cursor.executemany(SEIS_CONFIG_UPSERT, zip(FOLD_CUBE_KEYS, values))
+
+    @staticmethod
+    def _bin_fold_cube(cursor, offset, indexes, phases):
+        # full offset classes are summed from the fold cube in bin order, the
+        # traces in the partial offset class below max offset are then added
+        # from traces, with idx_traces_offset they are a range of the index
+        offset_class = int(offset // OFFSET_CLASS_WIDTH)
+        class_offset = offset_class * OFFSET_CLASS_WIDTH
+        src_indexes = f"{", ".join("?" for _ in indexes)}"
+        sql_string = (
+            "UPDATE bins SET bin_count = bc FROM "
+            "(SELECT bin_sp, bin_rp, sum(trace_count) AS bc FROM fold_cube "
+            f"WHERE offset_class < ? AND src_index IN ({src_indexes}) "
+            "GROUP BY bin_sp, bin_rp"
+            ") AS bins_grouped "
+            "WHERE bins.bin_sp = bins_grouped.bin_sp AND "
+            "bins.bin_rp = bins_grouped.bin_rp;"
+        )
+        phases.start("bin")
+        phases.execute(cursor, sql_string, (offset_class, *indexes))
+        if class_offset < offset:
+            sql_string = (
+                "UPDATE bins SET bin_count = IFNULL(bin_count, 0) + bc FROM "
+                "(SELECT bin_sp, bin_rp, count(*) AS bc FROM traces tr "
+                "WHERE tr.offset >= ? AND tr.offset < ? AND "
+                f"tr.src_index IN ({src_indexes}) "
+                "GROUP BY tr.bin_sp, tr.bin_rp"
+                ") AS bins_grouped "
+                "WHERE bins.bin_sp = bins_grouped.bin_sp AND "
+                "bins.bin_rp = bins_grouped.bin_rp;"
+            )
+            cursor.execute(sql_string, (class_offset, offset, *indexes))
+
+    @staticmethod
+    def _get_traces_chunks(cursor, columns, rowids=None):
+        sql_string = f"SELECT {", ".join(columns)} FROM traces NOT INDEXED"
+        if rowids:
+            cursor.execute(f"{sql_string} WHERE rowid BETWEEN ? AND ?;", rowids)
+
+        else:
+            cursor.execute(f"{sql_string};")
+
+        while rows := cursor.fetchmany(NUMPY_CHUNK_SIZE):
+            yield np.fromiter(
+                chain.from_iterable(rows),
+                dtype=np.float64,
+                count=len(columns) * len(rows),
+            ).reshape(-1, len(columns)).T
+
+    @staticmethod
+    def _count_traces(chunks, offset, indexes, nb_bin_sp, nb_bin_rp):
+        # fold as a (nb_bin_sp, nb_bin_rp) array, bin (1, 1) is at [0, 0],
+        # traces outside the bin grid are not counted, NULL bins are read as
+        # nan and counted as bin 0, outside the grid
+        fold = np.zeros(nb_bin_sp * nb_bin_rp, dtype=np.int64)
+        for bin_sp, bin_rp, trace_offset, src_index in chunks:
+            bin_sp = np.nan_to_num(bin_sp).astype(np.int64) - 1
+            bin_rp = np.nan_to_num(bin_rp).astype(np.int64) - 1
+            selected = (
+                (trace_offset >= 0)
+                & (trace_offset < offset)
+                & np.isin(src_index, indexes)
+                & (bin_sp >= 0)
+                & (bin_sp < nb_bin_sp)
+                & (bin_rp >= 0)
+                & (bin_rp < nb_bin_rp)
+            )
+            fold += np.bincount(
+                bin_sp[selected] * nb_bin_rp + bin_rp[selected],
+                minlength=fold.size,
+            )
+
+        return fold.reshape(nb_bin_sp, nb_bin_rp)
+
+    @staticmethod
+    def _update_bin_counts(cursor, fold, progress=None):
+        # the counts are loaded in chunks into a temporary table keyed on the
+        # bin and applied to bins in one update, so bins needs no index on
+        # (bin_sp, bin_rp). Progress is called after each chunk and during
+        # the update
+        bin_sp, bin_rp = np.nonzero(fold)
+        values = list(
+            zip(
+                (bin_sp + 1).tolist(),
+                (bin_rp + 1).tolist(),
+                fold[bin_sp, bin_rp].tolist(),
+            )
+        )
+        cursor.execute("DROP TABLE IF EXISTS temp.bin_counts;")
+        cursor.execute(
+            "CREATE TEMP TABLE bin_counts ("
+            "bin_sp INTEGER, bin_rp INTEGER, bin_count INTEGER, "
+            "PRIMARY KEY (bin_sp, bin_rp)) WITHOUT ROWID;"
+        )
+        for first in range(0, len(values), UPDATE_CHUNK_SIZE):
+            cursor.executemany(
+                "INSERT INTO temp.bin_counts VALUES (?, ?, ?);",
+                values[first : first + UPDATE_CHUNK_SIZE],
+            )
+            if progress:
+                progress(
+                    0.5 * min(len(values), first + UPDATE_CHUNK_SIZE) / len(values)
+                )
+
+        DbTools._execute_with_progress(
+            cursor,
+            "UPDATE bins SET bin_count = bc.bin_count FROM temp.bin_counts AS bc "
+            "WHERE bins.bin_sp = bc.bin_sp AND bins.bin_rp = bc.bin_rp;",
+            max(1, fold.size * CLEAR_STEPS_PER_BIN),
+            (lambda fraction: progress(0.5 + 0.5 * fraction)) if progress else None,
+        )
+        cursor.execute("DROP TABLE temp.bin_counts;")
+
+    @staticmethod
+    def _bin_traces(cursor, offset, indexes, phases):
         sql_string = (
             "UPDATE bins SET bin_count = bc FROM "
             "(SELECT bin_sp, bin_rp, count(*) AS bc "
@@ -92,6 +1065,107 @@ class DbTools:
             f"tr.src_index IN ({", ".join("?" for _ in indexes)}) "
             "GROUP BY tr.bin_sp, tr.bin_rp"
             ") AS bins_grouped "
-            "WHERE bins.bin_sp = bins_grouped.bin_sp and bins.bin_rp = bins_grouped.bin_rp;"
+            "WHERE bins.bin_sp = bins_grouped.bin_sp "
+            "and bins.bin_rp = bins_grouped.bin_rp;"
         )
-        cursor.execute(sql_string, (offset, *indexes))
+        phases.start("bin")
+        phases.execute(cursor, sql_string, (offset, *indexes))
+
+    @staticmethod
+    def _bin_traces_delta(
+        cursor, offset, indexes, binned_offset, binned_indexes, phases
+    ):
+        # a trace is in the delta set if its selection state differs between
+        # the new and the binned parameters, when the indexes are unchanged
+        # only traces in between the two offsets can be in the delta set
+        if set(binned_indexes) == set(indexes):
+            min_offset = min(offset, binned_offset)
+
+        else:
+            min_offset = 0
+
+        max_offset = max(offset, binned_offset)
+        new_selection = (
+            "(tr.offset >= 0 AND tr.offset < ? AND "
+            f"tr.src_index IN ({", ".join("?" for _ in indexes)}))"
+        )
+        binned_selection = (
+            "(tr.offset >= 0 AND tr.offset < ? AND "
+            f"tr.src_index IN ({", ".join("?" for _ in binned_indexes)}))"
+        )
+        sql_string = (
+            "UPDATE bins SET bin_count = NULLIF(IFNULL(bin_count, 0) + delta, 0) "
+            "FROM (SELECT bin_sp, bin_rp, "
+            f"SUM({new_selection} - {binned_selection}) AS delta "
+            "FROM traces tr "
+            "WHERE "
+            "tr.offset >= ? AND tr.offset < ? AND "
+            f"{new_selection} != {binned_selection} "
+            "GROUP BY tr.bin_sp, tr.bin_rp"
+            ") AS bins_delta "
+            "WHERE bins.bin_sp = bins_delta.bin_sp and bins.bin_rp = bins_delta.bin_rp;"
+        )
+        new_values = (offset, *indexes)
+        binned_values = (binned_offset, *binned_indexes)
+        phases.start("delta")
+        phases.execute(
+            cursor,
+            sql_string,
+            (
+                *new_values,
+                *binned_values,
+                min_offset,
+                max_offset,
+                *new_values,
+                *binned_values,
+            ),
+        )
+
+    @staticmethod
+    def _get_bins_count(cursor):
+        return cursor.execute("SELECT count(*) FROM bins;").fetchone()[0]
+
+    @staticmethod
+    def _get_traces_signature(cursor):
+        # the changes to the traces are counted from the first time anything
+        # is built from the traces
+        install_traces_version(cursor)
+        return get_traces_signature(cursor)
+
+    def _get_config_values(self, cursor) -> dict[str, str]:
+        # all of seis_config in a single query, the cached values are
+        # refreshed with it
+        sql_string = "SELECT key, value FROM seis_config;"
+        self._config_values = dict(cursor.execute(sql_string).fetchall())
+        self._config = None
+        return self._config_values
+
+    def _get_config(self, cursor) -> SeisConfig:
+        return SeisConfig.from_values(self._get_config_values(cursor))
+
+    def _get_binned_parameters(self, cursor):
+        values = self._get_config_values(cursor)
+        if any(key not in values for key in BINNED_KEYS):
+            return None, None
+
+        if values["binned_traces"] != self._get_traces_signature(cursor):
+            return None, None
+
+        offset = float(values["binned_offset"])
+        indexes = [int(v) for v in values["binned_src_indexes"].split(",")]
+        return offset, indexes
+
+    def _set_binned_parameters(self, cursor, offset, indexes):
+        if offset is None:
+            keys = f"{", ".join("?" for _ in BINNED_KEYS)}"
+            cursor.execute(
+                f"DELETE FROM seis_config WHERE key IN ({keys});", BINNED_KEYS
+            )
+            return
+
+        values = [
+            str(float(offset)),
+            f"{", ".join(str(i) for i in indexes)}",
+            self._get_traces_signature(cursor),
+        ]
+        cursor.executemany(SEIS_CONFIG_UPSERT, zip(BINNED_KEYS, values))
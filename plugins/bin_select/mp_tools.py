@@ -0,0 +1,57 @@
+"""process pools that can be started from QGIS as well as from the command line"""
+
+import multiprocessing
+import multiprocessing.spawn
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+
+
+def get_mp_context():
+    """returns a spawn multiprocessing context, in QGIS sys.executable is the
+    QGIS application, so the worker processes are started with the python
+    interpreter of the QGIS installation. The executable is set for all spawn
+    contexts of the process, use process_pool to restore it afterwards
+    """
+    context = multiprocessing.get_context("spawn")
+    if Path(sys.executable).stem.lower().startswith("python"):
+        return context
+
+    if os.name == "nt":
+        python = Path(sys.exec_prefix) / "python.exe"
+
+    else:
+        python = Path(sys.exec_prefix) / "bin" / "python3"
+
+    if python.exists():
+        context.set_executable(str(python))
+
+    return context
+
+
+@contextmanager
+def process_pool(max_workers: int, **kwargs):
+    """ProcessPoolExecutor with the context of get_mp_context, the spawn
+    executable of the process is restored once the pool has shut down
+    """
+    executable = multiprocessing.spawn.get_executable()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers, mp_context=get_mp_context(), **kwargs
+        ) as executor:
+            yield executor
+
+    finally:
+        multiprocessing.spawn.set_executable(executable)
+
+
+def get_workers(workers: int | None = None) -> int:
+    """number of worker processes, by default one less than the number of cpus
+    to keep QGIS responsive
+    """
+    if workers:
+        return max(1, workers)
+
+    return max(1, (os.cpu_count() or 2) - 1)
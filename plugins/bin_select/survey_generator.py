@@ -0,0 +1,404 @@
+"""generates a synthetic survey database with the tables seis_config, bins and
+traces of an orthogonal or slanted acquisition geometry, to test and benchmark
+bin_select on surveys of any size
+"""
+
+import argparse
+import math
+import sqlite3
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+import numpy as np
+
+CHUNK_SIZE = 500_000
+FIRST_LINE = 1000
+TRACES_COLUMNS = (
+    "src_line",
+    "src_point",
+    "src_index",
+    "rcv_line",
+    "rcv_point",
+    "offset",
+    "azimuth",
+    "mid_point_x",
+    "mid_point_y",
+    "bin_sp",
+    "bin_rp",
+)
+SCHEMA = (
+    "CREATE TABLE seis_config (key TEXT PRIMARY KEY, value TEXT);",
+    "CREATE TABLE bins (id INTEGER PRIMARY KEY, bin_sp INTEGER, bin_rp INTEGER, "
+    "bin_count INTEGER);",
+    "CREATE UNIQUE INDEX idx_bins ON bins (bin_sp, bin_rp);",
+    "CREATE TABLE traces (id INTEGER PRIMARY KEY, src_line REAL, src_point REAL, "
+    "src_index INTEGER, rcv_line REAL, rcv_point REAL, offset REAL, azimuth REAL, "
+    "mid_point_x REAL, mid_point_y REAL, bin_sp INTEGER, bin_rp INTEGER);",
+)
+SEIS_CONFIG = {
+    "file_stem": "synthetic",
+    "easting_orig": 500_000.0,
+    "northing_orig": 2_500_000.0,
+    "epsg": 32640,
+    "offset": 4000.0,
+}
+
+
+@dataclass
+class Geometry:
+    """acquisition geometry in survey coordinates: receiver lines run along y
+    with spacing rcv_line_interval in x, source lines run along x with spacing
+    src_line_interval in y, or slanted by slant degrees. A source records the
+    patch of patch_lines receiver lines by patch_channels receivers around it.
+    The first source is at src_origin_x, src_origin_y, the first receiver at 0, 0.
+    The survey is rotated by azimuth, the bearing of the receiver lines
+    """
+
+    src_line_interval: float = 300.0
+    src_point_interval: float = 50.0
+    rcv_line_interval: float = 300.0
+    rcv_point_interval: float = 50.0
+    nb_src_lines: int = 20
+    nb_src_points: int = 200
+    nb_rcv_lines: int = 35
+    nb_rcv_points: int = 120
+    patch_lines: int = 12
+    patch_channels: int = 240
+    slant: float = 0.0
+    azimuth: float = 0.0
+    nb_src_indexes: int = 2
+    src_origin_x: float = 0.0
+    src_origin_y: float = 0.0
+
+    @classmethod
+    def from_traces(cls, nb_traces: int, **kwargs) -> "Geometry":
+        """geometry with about nb_traces traces, the receivers extend half a
+        patch beyond the sources so every source records a full patch
+        """
+        geometry = cls(**kwargs)
+        nb_sources = max(1, math.ceil(nb_traces / geometry.patch_size))
+        geometry.nb_src_points = min(geometry.nb_src_points, nb_sources)
+        geometry.nb_src_lines = math.ceil(nb_sources / geometry.nb_src_points)
+        geometry.src_origin_x = geometry.patch_lines // 2 * geometry.rcv_line_interval
+        geometry.src_origin_y = (
+            geometry.patch_channels // 2 * geometry.rcv_point_interval
+        )
+        src_x, src_y = geometry.sources(0, geometry.nb_sources)[2:]
+        geometry.nb_rcv_lines = (
+            math.ceil(src_x.max() / geometry.rcv_line_interval)
+            + geometry.patch_lines // 2
+            + 1
+        )
+        geometry.nb_rcv_points = (
+            math.ceil(src_y.max() / geometry.rcv_point_interval)
+            + geometry.patch_channels // 2
+            + 1
+        )
+        return geometry
+
+    @property
+    def patch_size(self) -> int:
+        return self.patch_lines * self.patch_channels
+
+    @property
+    def nb_sources(self) -> int:
+        return self.nb_src_lines * self.nb_src_points
+
+    @property
+    def bin_sp_int(self) -> float:
+        return self.src_point_interval / 2
+
+    @property
+    def bin_rp_int(self) -> float:
+        return self.rcv_point_interval / 2
+
+    def sources(self, first: int, last: int) -> tuple[np.ndarray, ...]:
+        """line and point index and x, y of the sources first to last"""
+        source = np.arange(first, last)
+        line, point = np.divmod(source, self.nb_src_points)
+        slant = np.radians(self.slant)
+        x = self.src_origin_x + point * self.src_point_interval * np.cos(slant)
+        y = (
+            self.src_origin_y
+            + line * self.src_line_interval
+            + point * self.src_point_interval * np.sin(slant)
+        )
+        if slant < 0:
+            # keep the survey at positive y
+            y -= (self.nb_src_points - 1) * self.src_point_interval * np.sin(slant)
+
+        return line, point, x, y
+
+    def receivers(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, ...]:
+        """receiver line and point indexes of the patch of each source, shape
+        (sources, patch_lines, patch_channels), -1 outside the spread
+        """
+        half_lines = self.patch_lines // 2
+        half_channels = self.patch_channels // 2
+        center_line = np.rint(x / self.rcv_line_interval).astype(int)
+        center_point = np.rint(y / self.rcv_point_interval).astype(int)
+        lines = (
+            center_line[:, None, None]
+            + np.arange(self.patch_lines)[None, :, None]
+            - half_lines
+        )
+        points = (
+            center_point[:, None, None]
+            + np.arange(self.patch_channels)[None, None, :]
+            - half_channels
+        )
+        lines, points = np.broadcast_arrays(lines, points)
+        outside = (
+            (lines < 0)
+            | (lines >= self.nb_rcv_lines)
+            | (points < 0)
+            | (points >= self.nb_rcv_points)
+        )
+        return np.where(outside, -1, lines), np.where(outside, -1, points)
+
+    def extent(self) -> tuple[float, float]:
+        """max x and y of the midpoints"""
+        _, _, x, y = self.sources(0, self.nb_sources)
+        max_x = max(x.max(), (self.nb_rcv_lines - 1) * self.rcv_line_interval)
+        max_y = max(y.max(), (self.nb_rcv_points - 1) * self.rcv_point_interval)
+        return max_x, max_y
+
+
+class SurveyGenerator:
+    """writes the traces of all sources with their patch, the offset and
+    azimuth are from the source to the receiver in world coordinates and the
+    bins are the cells of bin_sp_int by bin_rp_int around the midpoint, the
+    center of bin (1, 1) is at the origin. Sources are
+    processed in chunks and inserted in bulk, so the number of traces is not
+    limited by memory
+    """
+
+    def __init__(self, db_file: Path, geometry: Geometry):
+        self.db_file = Path(db_file)
+        self.geometry = geometry
+        max_x, max_y = geometry.extent()
+        self.nb_bin_sp = int(self.bin_index(max_x, geometry.bin_sp_int))
+        self.nb_bin_rp = int(self.bin_index(max_y, geometry.bin_rp_int))
+        azimuth = np.radians(geometry.azimuth)
+        self.sin_az, self.cos_az = np.sin(azimuth), np.cos(azimuth)
+        self.config = dict(
+            SEIS_CONFIG,
+            azimuth=geometry.azimuth,
+            bin_sp_int=geometry.bin_sp_int,
+            bin_rp_int=geometry.bin_rp_int,
+            nb_bin_sp=self.nb_bin_sp,
+            nb_bin_rp=self.nb_bin_rp,
+            src_indexes=", ".join(
+                str(i) for i in range(1, geometry.nb_src_indexes + 1)
+            ),
+        )
+
+    @staticmethod
+    def bin_index(position, bin_int: float):
+        """bins are centered on the midpoints of the regular geometry, with the
+        center of the first bin at the origin
+        """
+        return np.floor(np.asarray(position) / bin_int + 0.5).astype(int) + 1
+
+    def to_world(self, x: np.ndarray, y: np.ndarray) -> tuple[np.ndarray, ...]:
+        easting = self.config["easting_orig"] + x * self.cos_az + y * self.sin_az
+        northing = self.config["northing_orig"] - x * self.sin_az + y * self.cos_az
+        return easting, northing
+
+    def generate(self, progress=None) -> int:
+        """generate the database, progress is called with the number of traces
+        done and the total number of traces of a full patch for all sources.
+        Returns the number of traces
+        """
+        if self.db_file.exists():
+            self.db_file.unlink()
+
+        connection = sqlite3.connect(self.db_file)
+        connection.execute("PRAGMA journal_mode = OFF;")
+        connection.execute("PRAGMA synchronous = OFF;")
+        for sql_string in SCHEMA:
+            connection.execute(sql_string)
+
+        connection.executemany(
+            "INSERT INTO seis_config (key, value) VALUES (?, ?);",
+            [(key, str(value)) for key, value in self.config.items()],
+        )
+        connection.executemany(
+            "INSERT INTO bins (bin_sp, bin_rp) VALUES (?, ?);",
+            (
+                (bin_sp, bin_rp)
+                for bin_sp in range(1, self.nb_bin_sp + 1)
+                for bin_rp in range(1, self.nb_bin_rp + 1)
+            ),
+        )
+        self.add_bins_geometry(connection)
+        sql_string = (
+            f"INSERT INTO traces ({", ".join(TRACES_COLUMNS)}) "
+            f"VALUES ({", ".join("?" * len(TRACES_COLUMNS))});"
+        )
+        geometry = self.geometry
+        sources_per_chunk = max(1, CHUNK_SIZE // geometry.patch_size)
+        total = geometry.nb_sources * geometry.patch_size
+        nb_traces = 0
+        for first in range(0, geometry.nb_sources, sources_per_chunk):
+            last = min(first + sources_per_chunk, geometry.nb_sources)
+            columns = self.traces_chunk(first, last)
+            connection.executemany(sql_string, zip(*columns))
+            nb_traces += len(columns[0])
+            if progress:
+                progress(last * geometry.patch_size, total)
+
+        connection.commit()
+        connection.close()
+        return nb_traces
+
+    def add_bins_geometry(self, connection: sqlite3.Connection) -> None:
+        """add the bin cells as polygon geometry to bins for the QGIS layer,
+        skipped if spatialite is not available
+        """
+        try:
+            connection.enable_load_extension(True)
+            connection.execute('SELECT load_extension("mod_spatialite")')
+            connection.execute("SELECT InitSpatialMetadata(1);")
+            connection.execute(
+                "SELECT AddGeometryColumn('bins', 'geometry', ?, 'POLYGON', 'XY');",
+                (self.config["epsg"],),
+            )
+
+        except (AttributeError, sqlite3.Error) as error:
+            print(f"bins without geometry, spatialite not available: {error}")
+            return
+
+        bins = connection.execute("SELECT id, bin_sp, bin_rp FROM bins;").fetchall()
+        ids, bin_sp, bin_rp = np.array(bins).T
+        bin_sp_int, bin_rp_int = self.geometry.bin_sp_int, self.geometry.bin_rp_int
+        x, y = (bin_sp - 1) * bin_sp_int, (bin_rp - 1) * bin_rp_int
+        # corners of the cells around the bin centers, closing the ring
+        corners = [
+            self.to_world(x + dx * bin_sp_int / 2, y + dy * bin_rp_int / 2)
+            for dx, dy in ((-1, -1), (1, -1), (1, 1), (-1, 1), (-1, -1))
+        ]
+        eastings = np.column_stack([easting for easting, _ in corners]).tolist()
+        northings = np.column_stack([northing for _, northing in corners]).tolist()
+        polygons = (
+            "POLYGON(({}))".format(
+                ", ".join(f"{e} {n}" for e, n in zip(easting, northing))
+            )
+            for easting, northing in zip(eastings, northings)
+        )
+        connection.executemany(
+            "UPDATE bins SET geometry = GeomFromText(?, ?) WHERE id = ?;",
+            zip(polygons, [self.config["epsg"]] * len(ids), ids.tolist()),
+        )
+        connection.execute("SELECT CreateSpatialIndex('bins', 'geometry');")
+
+    def traces_chunk(self, first: int, last: int) -> list[list]:
+        """columns of the traces of sources first to last as lists in the order
+        of TRACES_COLUMNS, line and point numbers are station numbers of half
+        a bin, so the mean of the source line and receiver point is the bin
+        """
+        geometry = self.geometry
+        src_line, src_point, src_x, src_y = geometry.sources(first, last)
+        rcv_line, rcv_point = geometry.receivers(src_x, src_y)
+        src_index = src_line % geometry.nb_src_indexes + 1
+        active = rcv_line >= 0
+        source = np.nonzero(active)[0]
+        rcv_line, rcv_point = rcv_line[active], rcv_point[active]
+        src_x, src_y = src_x[source], src_y[source]
+        rcv_x = rcv_line * geometry.rcv_line_interval
+        rcv_y = rcv_point * geometry.rcv_point_interval
+        mid_x, mid_y = (src_x + rcv_x) / 2, (src_y + rcv_y) / 2
+        src_easting, src_northing = self.to_world(src_x, src_y)
+        rcv_easting, rcv_northing = self.to_world(rcv_x, rcv_y)
+        mid_easting, mid_northing = self.to_world(mid_x, mid_y)
+        d_easting = rcv_easting - src_easting
+        d_northing = rcv_northing - src_northing
+        station_sp = geometry.bin_sp_int
+        station_rp = geometry.bin_rp_int
+        return [
+            (FIRST_LINE + np.round(src_y / station_rp, 1)).tolist(),
+            (FIRST_LINE + np.round(src_x / station_sp, 1)).tolist(),
+            src_index[source].tolist(),
+            (FIRST_LINE + np.round(rcv_x / station_sp, 1)).tolist(),
+            (FIRST_LINE + np.round(rcv_y / station_rp, 1)).tolist(),
+            np.hypot(d_easting, d_northing).tolist(),
+            np.degrees(np.arctan2(d_easting, d_northing)).tolist(),
+            mid_easting.tolist(),
+            mid_northing.tolist(),
+            self.bin_index(mid_x, geometry.bin_sp_int).tolist(),
+            self.bin_index(mid_y, geometry.bin_rp_int).tolist(),
+        ]
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(
+        prog="survey_generator", description="generate a synthetic survey database"
+    )
+    parser.add_argument("db_file", type=Path, help="database file to create")
+    parser.add_argument(
+        "--traces",
+        type=int,
+        help="about this number of traces, sets the number of lines and points",
+    )
+    parser.add_argument("--src-lines", type=int, default=Geometry.nb_src_lines)
+    parser.add_argument("--src-points", type=int, default=Geometry.nb_src_points)
+    parser.add_argument("--rcv-lines", type=int, default=Geometry.nb_rcv_lines)
+    parser.add_argument("--rcv-points", type=int, default=Geometry.nb_rcv_points)
+    parser.add_argument(
+        "--intervals",
+        type=float,
+        nargs=4,
+        metavar=("SLI", "SPI", "RLI", "RPI"),
+        default=(
+            Geometry.src_line_interval,
+            Geometry.src_point_interval,
+            Geometry.rcv_line_interval,
+            Geometry.rcv_point_interval,
+        ),
+        help="source line and point, receiver line and point intervals",
+    )
+    parser.add_argument(
+        "--patch",
+        type=int,
+        nargs=2,
+        metavar=("LINES", "CHANNELS"),
+        default=(Geometry.patch_lines, Geometry.patch_channels),
+    )
+    parser.add_argument("--slant", type=float, default=Geometry.slant)
+    parser.add_argument("--azimuth", type=float, default=Geometry.azimuth)
+    parser.add_argument("--src-indexes", type=int, default=Geometry.nb_src_indexes)
+    args = parser.parse_args(argv[1:])
+    parameters = dict(
+        src_line_interval=args.intervals[0],
+        src_point_interval=args.intervals[1],
+        rcv_line_interval=args.intervals[2],
+        rcv_point_interval=args.intervals[3],
+        patch_lines=args.patch[0],
+        patch_channels=args.patch[1],
+        slant=args.slant,
+        azimuth=args.azimuth,
+        nb_src_indexes=args.src_indexes,
+    )
+    if args.traces:
+        geometry = Geometry.from_traces(args.traces, **parameters)
+
+    else:
+        geometry = Geometry(
+            nb_src_lines=args.src_lines,
+            nb_src_points=args.src_points,
+            nb_rcv_lines=args.rcv_lines,
+            nb_rcv_points=args.rcv_points,
+            **parameters,
+        )
+
+    def print_progress(done, total):
+        print(f"\rgenerated {done / total:.0%} of the traces", end="", flush=True)
+
+    nb_traces = SurveyGenerator(args.db_file, geometry).generate(
+        progress=print_progress
+    )
+    print(f"\ngenerated {nb_traces} traces")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
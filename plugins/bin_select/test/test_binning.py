@@ -0,0 +1,133 @@
+"""checks of the binning engines, the rebuild of the trace store and fold cube
+after changes to the traces and the paths BinAttributes reads the traces from,
+on a small survey of the survey generator
+"""
+
+import shutil
+import sqlite3
+import numpy as np
+import pytest
+from ..bin_attributes import TRACE_DTYPE, BinAttributes
+from ..db_tools import BINNING_ENGINES, OFFSET_CLASS_WIDTH, DbTools
+from ..survey_generator import Geometry, SurveyGenerator
+from ..trace_store import TraceStore, get_traces_signature
+
+SURVEY_TRACES = 20_000
+SURVEY_OFFSET = 4000.0
+SURVEY_INDEXES = [1, 2]
+BIN_RANGE = (40, 44, 88, 92)
+
+
+@pytest.fixture(scope="module")
+def survey_file(tmp_path_factory):
+    db_file = tmp_path_factory.mktemp("survey") / "survey.sqlite"
+    geometry = Geometry.from_traces(
+        SURVEY_TRACES, nb_src_points=10, patch_lines=6, patch_channels=60
+    )
+    SurveyGenerator(db_file, geometry).generate()
+    return db_file
+
+
+@pytest.fixture
+def db_file(survey_file, tmp_path):
+    db_file = tmp_path / survey_file.name
+    shutil.copy(survey_file, db_file)
+    yield db_file
+    DbTools(db_file).close()
+    TraceStore(db_file).remove()
+
+
+def get_fold(db_file) -> list[tuple[int, int, int]]:
+    connection = sqlite3.connect(db_file)
+    fold = connection.execute(
+        "SELECT bin_sp, bin_rp, bin_count FROM bins WHERE bin_count > 0 "
+        "ORDER BY bin_sp, bin_rp;"
+    ).fetchall()
+    connection.close()
+    return fold
+
+
+def update_traces(db_file, sql_string):
+    connection = sqlite3.connect(db_file)
+    connection.execute(sql_string)
+    connection.commit()
+    connection.close()
+
+
+def get_traces(db_file) -> tuple[np.ndarray, BinAttributes]:
+    ba = BinAttributes(db_file, (0, 0), SURVEY_OFFSET, SURVEY_INDEXES)
+    traces = np.sort(ba.get_bin_range(*BIN_RANGE), order=TRACE_DTYPE.names)
+    ba.close()
+    return traces, ba
+
+
+@pytest.mark.parametrize("engine", BINNING_ENGINES)
+@pytest.mark.parametrize(
+    "offset", [SURVEY_OFFSET, 20 * OFFSET_CLASS_WIDTH, 1234.5, OFFSET_CLASS_WIDTH - 1]
+)
+@pytest.mark.parametrize("indexes", [SURVEY_INDEXES, [2]])
+@pytest.mark.parametrize("null_bins", [False, True])
+def test_engine_fold(db_file, engine, offset, indexes, null_bins):
+    if null_bins:
+        # traces that are not binned, for example outside the grid
+        update_traces(db_file, "UPDATE traces SET bin_sp = NULL WHERE id % 7 = 0;")
+
+    db_tools = DbTools(db_file)
+    assert db_tools.bin_traces(offset, indexes)
+    fold = get_fold(db_file)
+    assert fold
+
+    # a previous binning with other parameters, so the incremental engine
+    # bins the difference and the fold cube engine reuses its cube
+    bin_traces = getattr(db_tools, BINNING_ENGINES[engine])
+    assert bin_traces(SURVEY_OFFSET, SURVEY_INDEXES)
+    assert bin_traces(offset, indexes)
+    assert get_fold(db_file) == fold
+
+
+def test_rebuild_after_edit(db_file):
+    db_tools = DbTools(db_file)
+    db_tools.build_trace_store(None)
+    assert db_tools.bin_traces_fold_cube(SURVEY_OFFSET, SURVEY_INDEXES)
+    trace_store = TraceStore(db_file)
+    connection = sqlite3.connect(db_file)
+    assert trace_store.is_current(connection.cursor())
+
+    update_traces(db_file, "UPDATE traces SET offset = offset / 2 WHERE id % 3 = 0;")
+    signature = get_traces_signature(connection.cursor())
+    cube_signature = connection.execute(
+        "SELECT value FROM seis_config WHERE key = 'fold_cube_traces';"
+    ).fetchone()[0]
+    assert not trace_store.is_current(connection.cursor())
+    assert cube_signature != signature
+
+    assert db_tools.bin_traces(SURVEY_OFFSET, SURVEY_INDEXES)
+    fold = get_fold(db_file)
+    assert db_tools.bin_traces_numpy(SURVEY_OFFSET, SURVEY_INDEXES)
+    assert get_fold(db_file) == fold
+    assert db_tools.bin_traces_fold_cube(SURVEY_OFFSET, SURVEY_INDEXES)
+    assert get_fold(db_file) == fold
+    assert trace_store.is_current(connection.cursor())
+    cube_signature = connection.execute(
+        "SELECT value FROM seis_config WHERE key = 'fold_cube_traces';"
+    ).fetchone()[0]
+    assert cube_signature == signature
+    connection.close()
+
+
+def test_bin_attributes_paths(db_file):
+    traces_sql, ba = get_traces(db_file)
+    assert not ba.trace_store and not ba.bin_directory
+    assert len(traces_sql)
+
+    db_tools = DbTools(db_file)
+    assert db_tools.cluster_traces(None)
+    traces_clustered, ba = get_traces(db_file)
+    assert not ba.trace_store and ba.bin_directory
+
+    db_tools.build_trace_store(None)
+    traces_store, ba = get_traces(db_file)
+    assert ba.trace_store
+
+    np.testing.assert_array_equal(traces_clustered, traces_sql)
+    np.testing.assert_array_equal(traces_store, traces_sql)
@@ -0,0 +1,294 @@
+"""bin sorted columnar copy of the traces table, each column is a .npy file that
+is memory mapped, the traces of a bin are a contiguous slice of the columns
+given by the bin offset index bin_start. The SQLite database is the source of
+truth, the store records the signature of the traces table and the bin grid it
+was built from
+"""
+
+import json
+import shutil
+from itertools import chain
+from pathlib import Path
+import numpy as np
+from numpy.lib.format import open_memmap
+
+STORE_DTYPE = np.dtype(
+    [
+        ("bin_sp", np.int32),
+        ("bin_rp", np.int32),
+        ("src_index", np.int32),
+        ("offset", np.float64),
+        ("azimuth", np.float32),
+        ("src_line", np.float32),
+        ("src_point", np.float32),
+        ("rcv_line", np.float32),
+        ("rcv_point", np.float32),
+        ("mid_point_x", np.float64),
+        ("mid_point_y", np.float64),
+    ]
+)
+BIN_START = "bin_start"
+STORE_FILE = "store.json"
+STORE_CHUNK_SIZE = 1_000_000
+TRACES_VERSION_TRIGGERS = {
+    "traces_version_insert": "INSERT",
+    "traces_version_update": "UPDATE",
+    "traces_version_delete": "DELETE",
+}
+
+
+def install_traces_version(cursor) -> None:
+    """count the changes to the traces table in the table traces_version with
+    a trigger on each insert, update and delete of a trace. The version is
+    incremented when the triggers are (re)created, the traces may have
+    changed while they were missing, for example when the table is rebuilt
+    """
+    if has_traces_version(cursor):
+        return
+
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS traces_version (version INTEGER NOT NULL);"
+    )
+    if not cursor.execute("SELECT version FROM traces_version;").fetchone():
+        cursor.execute("INSERT INTO traces_version (version) VALUES (0);")
+
+    for name, operation in TRACES_VERSION_TRIGGERS.items():
+        cursor.execute(
+            f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {operation} ON traces "
+            f"BEGIN UPDATE traces_version SET version = version + 1; END;"
+        )
+
+    cursor.execute("UPDATE traces_version SET version = version + 1;")
+
+
+def has_traces_version(cursor) -> bool:
+    triggers = cursor.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND "
+        "tbl_name = 'traces' AND "
+        f"name IN ({", ".join("?" for _ in TRACES_VERSION_TRIGGERS)});",
+        tuple(TRACES_VERSION_TRIGGERS),
+    ).fetchone()[0]
+    return triggers == len(TRACES_VERSION_TRIGGERS)
+
+
+def get_traces_signature(cursor) -> str | None:
+    """signature of the traces table, the version that counts the changes to
+    the traces. None if the changes are not counted, then nothing built from
+    the traces can be trusted to be current
+    """
+    if not has_traces_version(cursor):
+        return None
+
+    version = cursor.execute("SELECT version FROM traces_version;").fetchone()
+    return f"version {version[0]}" if version else None
+
+
+class TraceStore:
+    """the store of a database is the folder <database stem>_traces next to the
+    database, traces outside the bin grid are not stored
+    """
+
+    def __init__(self, db_file: Path):
+        db_file = Path(db_file)
+        self.folder = db_file.parent / f"{db_file.stem}_traces"
+        self.columns = None
+        self.bin_start = None
+        self.nb_bin_sp = None
+        self.nb_bin_rp = None
+
+    def exists(self) -> bool:
+        return (self.folder / STORE_FILE).exists()
+
+    def get_info(self) -> dict:
+        return json.loads((self.folder / STORE_FILE).read_text())
+
+    def is_current(self, cursor) -> bool:
+        """True if the traces and the bin grid have not changed since the store
+        was built
+        """
+        if not self.exists():
+            return False
+
+        info = self.get_info()
+        grid = dict(
+            cursor.execute(
+                "SELECT key, value FROM seis_config "
+                "WHERE key IN ('nb_bin_sp', 'nb_bin_rp');"
+            ).fetchall()
+        )
+        signature = get_traces_signature(cursor)
+        return (
+            signature is not None
+            and info["signature"] == signature
+            and info["nb_bin_sp"] == int(float(grid.get("nb_bin_sp", -1)))
+            and info["nb_bin_rp"] == int(float(grid.get("nb_bin_rp", -1)))
+        )
+
+    def open(self) -> "TraceStore":
+        """memory map the columns, nothing is read until the columns are used"""
+        if self.columns is None:
+            info = self.get_info()
+            self.nb_bin_sp = info["nb_bin_sp"]
+            self.nb_bin_rp = info["nb_bin_rp"]
+            self.bin_start = np.load(self.folder / f"{BIN_START}.npy", mmap_mode="r")
+            self.columns = {
+                name: np.load(self.folder / f"{name}.npy", mmap_mode="r")
+                for name in STORE_DTYPE.names
+            }
+
+        return self
+
+    def close(self) -> None:
+        self.columns = None
+        self.bin_start = None
+
+    def remove(self) -> None:
+        self.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def build(
+        self, cursor, nb_bin_sp: int, nb_bin_rp: int, progress=None, cancelled=None
+    ) -> int | None:
+        """build the store from the traces table in two passes, the first
+        counts the traces per bin for the bin offset index, the second writes
+        the traces to their bin. Within a bin the traces keep the order of the
+        table. The store is built in a temporary folder that replaces the
+        store when complete. Returns the number of traces stored, or None if
+        cancelled returned True, the store is then as it was
+        """
+        install_traces_version(cursor)
+        self.close()
+        nb_bins = nb_bin_sp * nb_bin_rp
+        part_folder = self.folder.with_name(f"{self.folder.name}.part")
+        shutil.rmtree(part_folder, ignore_errors=True)
+        part_folder.mkdir(parents=True)
+
+        counts = np.zeros(nb_bins, dtype=np.int64)
+        # traces without a bin are not stored, as they are not in the grid
+        binned = "WHERE bin_sp IS NOT NULL AND bin_rp IS NOT NULL"
+        cursor.execute(f"SELECT bin_sp, bin_rp FROM traces {binned};")
+        while rows := cursor.fetchmany(STORE_CHUNK_SIZE):
+            if cancelled and cancelled():
+                shutil.rmtree(part_folder, ignore_errors=True)
+                return None
+
+            bins = np.fromiter(
+                chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)
+            ).reshape(-1, 2)
+            index, valid = self._bin_index(bins[:, 0], bins[:, 1], nb_bin_sp, nb_bin_rp)
+            counts += np.bincount(index[valid], minlength=nb_bins)
+
+        bin_start = np.zeros(nb_bins + 1, dtype=np.int64)
+        np.cumsum(counts, out=bin_start[1:])
+        np.save(part_folder / f"{BIN_START}.npy", bin_start)
+        nb_traces = int(bin_start[-1])
+        columns = {
+            name: open_memmap(
+                part_folder / f"{name}.npy",
+                mode="w+",
+                dtype=STORE_DTYPE[name],
+                shape=(nb_traces,),
+            )
+            for name in STORE_DTYPE.names
+        }
+
+        next_row = bin_start[:-1].copy()
+        done = 0
+        cursor.execute(f"SELECT {", ".join(STORE_DTYPE.names)} FROM traces {binned};")
+        while rows := cursor.fetchmany(STORE_CHUNK_SIZE):
+            if cancelled and cancelled():
+                del columns
+                shutil.rmtree(part_folder, ignore_errors=True)
+                return None
+
+            traces = np.fromiter(rows, dtype=STORE_DTYPE, count=len(rows))
+            index, valid = self._bin_index(
+                traces["bin_sp"], traces["bin_rp"], nb_bin_sp, nb_bin_rp
+            )
+            order = np.flatnonzero(valid)[np.argsort(index[valid], kind="stable")]
+            index = index[order]
+            # row of a trace is the next free row of its bin plus its rank
+            # among the traces of the same bin in this chunk
+            rank = np.arange(len(index)) - np.searchsorted(index, index)
+            rows_out = next_row[index] + rank
+            for name, column in columns.items():
+                column[rows_out] = traces[name][order]
+
+            next_row += np.bincount(index, minlength=nb_bins)
+            done += len(index)
+            if progress:
+                progress(done / max(1, nb_traces))
+
+        for column in columns.values():
+            column.flush()
+
+        del columns
+        info = {
+            "signature": get_traces_signature(cursor),
+            "nb_bin_sp": nb_bin_sp,
+            "nb_bin_rp": nb_bin_rp,
+            "traces": nb_traces,
+        }
+        (part_folder / STORE_FILE).write_text(json.dumps(info, indent=2))
+        shutil.rmtree(self.folder, ignore_errors=True)
+        part_folder.rename(self.folder)
+        return nb_traces
+
+    @staticmethod
+    def _bin_index(bin_sp, bin_rp, nb_bin_sp, nb_bin_rp) -> tuple:
+        # linear bin index, bin (1, 1) is 0, and if the bin is in the grid
+        bin_sp = np.asarray(bin_sp, dtype=np.int64) - 1
+        bin_rp = np.asarray(bin_rp, dtype=np.int64) - 1
+        valid = (
+            (bin_sp >= 0) & (bin_sp < nb_bin_sp) & (bin_rp >= 0) & (bin_rp < nb_bin_rp)
+        )
+        return bin_sp * nb_bin_rp + bin_rp, valid
+
+    def chunks(
+        self,
+        names: tuple[str],
+        chunk_size: int = STORE_CHUNK_SIZE,
+        start: int = 0,
+        end: int | None = None,
+    ):
+        """yields the columns names in chunks of rows, the chunks are slices of
+        the memory mapped columns. start and end are the first and last row
+        """
+        self.open()
+        end = int(self.bin_start[-1]) if end is None else end + 1
+        for first in range(start, end, chunk_size):
+            last = min(end, first + chunk_size)
+            yield [self.columns[name][first:last] for name in names]
+
+    def get_bin_range(
+        self,
+        bin_src_min: int,
+        bin_src_max: int,
+        bin_rcv_min: int,
+        bin_rcv_max: int,
+        offset: float,
+        src_indexes: list[int],
+        names: tuple[str],
+    ) -> dict[str, np.ndarray]:
+        """the columns names of the traces in the range of bins with an offset
+        below offset and a source index in src_indexes, sorted by bin. The
+        bins of a source bin are a contiguous slice of the store
+        """
+        self.open()
+        bin_rcv_min = max(1, bin_rcv_min)
+        bin_rcv_max = min(self.nb_bin_rp, bin_rcv_max)
+        selection = {name: [self.columns[name][:0]] for name in names}
+        if bin_rcv_min > bin_rcv_max:
+            return {name: np.concatenate(arrays) for name, arrays in selection.items()}
+
+        for bin_src in range(max(1, bin_src_min), min(self.nb_bin_sp, bin_src_max) + 1):
+            first_bin = (bin_src - 1) * self.nb_bin_rp + bin_rcv_min - 1
+            last_bin = (bin_src - 1) * self.nb_bin_rp + bin_rcv_max
+            rows = slice(self.bin_start[first_bin], self.bin_start[last_bin])
+            selected = (self.columns["offset"][rows] < offset) & np.isin(
+                self.columns["src_index"][rows], src_indexes
+            )
+            for name in names:
+                selection[name].append(self.columns[name][rows][selected])
+
+        return {name: np.concatenate(arrays) for name, arrays in selection.items()}